@@ -1,37 +1,244 @@
-import os
-from flask import Flask, request, abort, jsonify
+import base64
+from flask import Flask, request, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from models import *
-from auth.auth import AuthError, requires_auth
-from datetime import datetime
+from auth.auth import AuthError, requires_auth, jwks_cache
+from validation import *
+from bulk import bulk_records, bulk_insert, actor_row, movie_row, upload_records, import_rows
+from export import export_format, stream_export
+from json_provider import jsonify, Rows
+from conditional import conditional
+from response_cache import cached, init_response_cache
+from internal import internal
+from timing import init_timing
+from metrics import init_metrics
 
 #Pagination function:
 DATA_PER_PAGE = 10
-def paginations(request,data):
+MAX_DATA_PER_PAGE = 100
+def paginations(request,query):
+  ''' applies LIMIT/OFFSET of the requested page to the query, only the rows of that page are loaded'''
   page=request.args.get('page',1,type=int)
+  per_page=request.args.get('per_page',DATA_PER_PAGE,type=int)
+  if page<1 or per_page<1:
+    abort(400)
+  per_page=min(per_page,MAX_DATA_PER_PAGE)
 
-  start=(page-1)*DATA_PER_PAGE
-  end=start+DATA_PER_PAGE
-  data_list=[i.format() for i in data]
-  page_data=data_list[start:end]
+  start=(page-1)*per_page
+  page_data=query.offset(start).limit(per_page).all()
   if len(page_data)==0:
     abort(404)
 
   return page_data
 
 
+#Keyset (cursor) pagination:
+def encode_cursor(last_id):
+  return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+def decode_cursor(cursor):
+  try:
+    return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+  except:
+    abort(400)
+
+def cursor_paginations(request,model,query):
+  ''' returns the rows following the 'after' cursor ordered by id and the cursor of the next page,
+  every page is an indexed range scan on the primary key no matter how deep it is'''
+  limit=request.args.get('limit',DATA_PER_PAGE,type=int)
+  if limit<1:
+    abort(400)
+  limit=min(limit,MAX_DATA_PER_PAGE)
+
+  query=query.order_by(model.id)
+  cursor=request.args.get('after')
+  if cursor:
+    query=query.filter(model.id>decode_cursor(cursor))
+  rows=query.limit(limit+1).all() #one extra row tells if there is a next page
+
+  next_cursor=None
+  if len(rows)>limit:
+    rows=rows[:limit]
+    next_cursor=encode_cursor(rows[-1].id)
+
+  return rows,next_cursor
+
+def cursor_mode(request):
+  return 'after' in request.args or 'limit' in request.args
+
+
+#Sparse fieldsets:
+def selected_fields(request,model):
+  ''' fields of the 'fields' argument (fields=name,age), all the fields by default'''
+  fields=request.args.get('fields')
+  if fields is None:
+    return model.FIELDS
+  fields=[f.strip() for f in fields.split(',') if f.strip()]
+  if len(fields)==0 or any(f not in model.FIELDS for f in fields):
+    abort(400)
+  return fields
+
+def rows_query(model,fields):
+  ''' selects only the id and the requested columns, no ORM entity is built'''
+  return db.session.query(model.id,*[getattr(model,f) for f in fields])
+
+def format_rows(request,fields,rows,related=None):
+  ''' one object per row, or one array per field in compact mode (compact=true),
+  the rows are serialized as they are by jsonify'''
+  compact=request.args.get('compact','false').lower() in ['true','1']
+  return Rows(fields,rows,compact,related=related)
+
+
+#Castings:
+def cast_query(model):
+  ''' castings of the model joined to the other side of the relation (the actors of the movies,
+  the movies of the actors), returns the column of the model's id, the query and its fields'''
+  if model is Movies:
+    key,other,other_key=Castings.movie_id,Actors,Castings.actor_id
+  else:
+    key,other,other_key=Castings.actor_id,Movies,Castings.movie_id
+  fields=['id']+other.FIELDS+Castings.FIELDS
+  columns=[other.id]+[getattr(other,f) for f in other.FIELDS]+[getattr(Castings,f) for f in Castings.FIELDS]
+  query=db.session.query(key,*columns).join(other,other.id==other_key).order_by(key,other.id)
+  return key,query,fields
+
+def include_cast(request):
+  return 'cast' in request.args.get('include','').split(',')
+
+def load_cast(model,rows):
+  ''' cast of every row of a page with one query whatever the page size (WHERE id IN (...)),
+  the way a selectinload would, as {row id: [casting,...]}'''
+  key,query,fields=cast_query(model)
+  cast={}
+  for row in query.filter(key.in_([row[0] for row in rows])):
+    cast.setdefault(row[0],[]).append(dict(zip(fields,row[1:])))
+  return {'cast':cast}
+
+def date_range(request):
+  ''' the start and end arguments (yyyy-mm-dd, both included), both are required'''
+  start,end=request.args.get('start'),request.args.get('end')
+  if not (valid_release_date(start) and valid_release_date(end)):
+    abort(400)
+  start,end=parse_date(start),parse_date(end)
+  if start>end:
+    abort(400)
+  return start,end
+
+def available_filter(start,end):
+  ''' the actors without any casting during [start, end]'''
+  busy=db.session.query(Castings.id).filter(Castings.actor_id==Actors.id,overlapping(start,end))
+  return ~busy.exists()
+
+def exists(model,id):
+  return db.session.query(model.id).filter(model.id==id).scalar() is not None
+
+
+#Filters and sort:
+def count_filtered(model,criteria):
+  ''' number of rows matching the filters, the maintained counter is used when there is none'''
+  if len(criteria)==0:
+    return count_rows(model)
+  return db.session.query(db.func.count(model.id)).filter(*criteria).scalar()
+
+def movies_filters(request):
+  ''' criteria of the released_after/released_before arguments (yyyy-mm-dd, both included)'''
+  criteria=[]
+  released_after=request.args.get('released_after')
+  if released_after is not None:
+    if not valid_release_date(released_after):
+      abort(400)
+    criteria.append(Movies.release_date>=parse_date(released_after))
+  released_before=request.args.get('released_before')
+  if released_before is not None:
+    if not valid_release_date(released_before):
+      abort(400)
+    criteria.append(Movies.release_date<=parse_date(released_before))
+  return criteria
+
+def int_arg(request,name):
+  value=request.args.get(name)
+  if value is None:
+    return None
+  try:
+    return int(value)
+  except ValueError:
+    abort(400)
+
+def escape_like(value):
+  return value.replace('/','//').replace('%','/%').replace('_','/_')
+
+def actors_filters(request):
+  ''' criteria of the gender, min_age, max_age (both included) and q (name prefix) arguments'''
+  criteria=[]
+  gender=request.args.get('gender')
+  if gender is not None:
+    if not valid_gender(gender):
+      abort(400)
+    criteria.append(Actors.gender==gender.lower())
+  min_age=int_arg(request,'min_age')
+  if min_age is not None:
+    criteria.append(Actors.age>=min_age)
+  max_age=int_arg(request,'max_age')
+  if max_age is not None:
+    criteria.append(Actors.age<=max_age)
+  q=request.args.get('q')
+  if q:
+    #case insensitive prefix, served by the index on lower(name)
+    criteria.append(db.func.lower(Actors.name).like(escape_like(q.lower())+'%',escape='/'))
+  return criteria
+
+MOVIES_SORTS={
+  'id':[Movies.id],
+  'release_date':[Movies.release_date,Movies.id],
+  '-release_date':[Movies.release_date.desc(),Movies.id.desc()]
+}
+
+def sort_order(request,sorts):
+  sort=request.args.get('sort','id')
+  if sort not in sorts:
+    abort(400)
+  return sorts[sort]
+
+
+#Batch updates and deletes:
+MAX_BATCH_IDS = 10000
+def batch_criteria(request,model,filters):
+  ''' rows of a batch: the "ids" of the body and/or the filters of the query string (the ones of
+  the GET endpoint), at least one of them is required so a batch can't touch the whole table.
+  A body is always parsed as JSON (whatever its content type), so ids can't be dropped silently'''
+  body={}
+  if request.content_length or request.data:
+    body=request.get_json(force=True) #malformed JSON: 400
+  if not isinstance(body,dict):
+    abort(400)
+  criteria=filters(request)
+  ids=body.get('ids')
+  if ids is not None:
+    if not valid_ids(ids) or len(ids)>MAX_BATCH_IDS:
+      abort(400)
+    criteria.append(model.id.in_(ids))
+  if len(criteria)==0:
+    abort(400)
+  return criteria,body
+
+
 #Creating the app
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
   CORS(app,resources={r'/*':{'origins':'*'}})
   setup_db(app) #configure the app and initiate the database
+  init_response_cache(app)
+  app.register_blueprint(internal)
+  init_timing(app,[db.engine]+replica_engines(app))
+  init_metrics(app,db.engine,jwks_cache)
 
 
   @app.after_request
   def after_request(response):
-    response.headers.add('Access-Control-Allow-Headers','Content-Type,Authorization,true')
+    response.headers.add('Access-Control-Allow-Headers','Content-Type,Authorization,If-None-Match,If-Modified-Since,true')
+    response.headers.add('Access-Control-Expose-Headers','ETag,Last-Modified,Server-Timing')
     response.headers.add('Access-Control-Allow-Methods','GET,POST,PATCH,DELETE')
     return response
 
@@ -39,29 +246,146 @@ def create_app(test_config=None):
   
   @app.route('/actors')
   @requires_auth('get:actors')
+  @conditional(Actors,{'cast':[Castings,Movies]})
+  @cached(Actors,{'cast':[Castings,Movies]})
   def get_actors():
-    actors=Actors.query.all()
+    criteria=actors_filters(request)
+    fields=selected_fields(request,Actors)
+    query=rows_query(Actors,fields).filter(*criteria)
+
+    if cursor_mode(request):
+      rows,next_cursor=cursor_paginations(request,Actors,query)
+      return jsonify({
+        'actors': format_rows(request,fields,rows,load_cast(Actors,rows) if include_cast(request) else None),
+        'next_cursor': next_cursor
+      })
+
+    total_actors=count_filtered(Actors,criteria)
     
-    if len(actors)==0:
+    if total_actors==0:
       abort(404)
     
+    rows=paginations(request,query.order_by(Actors.id))
     return jsonify({
-      'actors': paginations(request,actors),
-      'total_actors': len(actors)
+      'actors': format_rows(request,fields,rows,load_cast(Actors,rows) if include_cast(request) else None),
+      'total_actors': total_actors
     })
 
   @app.route('/movies')
   @requires_auth('get:movies')
+  @conditional(Movies,{'cast':[Castings,Actors]})
+  @cached(Movies,{'cast':[Castings,Actors]})
   def get_movies():
-    movies=Movies.query.all()
+    criteria=movies_filters(request)
+    fields=selected_fields(request,Movies)
+    query=rows_query(Movies,fields).filter(*criteria)
+
+    if cursor_mode(request):
+      if request.args.get('sort','id')!='id': #the cursor follows the ids
+        abort(400)
+      rows,next_cursor=cursor_paginations(request,Movies,query)
+      return jsonify({
+        'movies': format_rows(request,fields,rows,load_cast(Movies,rows) if include_cast(request) else None),
+        'next_cursor': next_cursor
+      })
+
+    order=sort_order(request,MOVIES_SORTS)
+    total_movies=count_filtered(Movies,criteria)
     
-    if len(movies)==0:
+    if total_movies==0:
       abort(404)
     
+    rows=paginations(request,query.order_by(*order))
+    return jsonify({
+      'movies': format_rows(request,fields,rows,load_cast(Movies,rows) if include_cast(request) else None),
+      'total_movies': total_movies
+    })
+
+  @app.route('/actors/available')
+  @requires_auth('get:actors')
+  def get_available_actors():
+    start,end=date_range(request)
+    criteria=actors_filters(request)+[available_filter(start,end)]
+    fields=selected_fields(request,Actors)
+    total_actors=count_filtered(Actors,criteria)
+
+    if total_actors==0:
+      abort(404)
+
+    query=rows_query(Actors,fields).filter(*criteria).order_by(Actors.id)
     return jsonify({
-      'movies': paginations(request,movies),
-      'total_movies': len(movies)
+      'actors': format_rows(request,fields,paginations(request,query)),
+      'total_actors': total_actors
     })
+
+  @app.route('/actors/export')
+  @requires_auth('get:actors')
+  def export_actors():
+    output=export_format(request) #format=ndjson (default) or csv
+    fields=['id']+selected_fields(request,Actors)
+    query=db.session.query(*[getattr(Actors,f) for f in fields]).filter(*actors_filters(request)).order_by(Actors.id)
+    return stream_export('actors',fields,query,output)
+
+  @app.route('/movies/export')
+  @requires_auth('get:movies')
+  def export_movies():
+    output=export_format(request)
+    fields=['id']+selected_fields(request,Movies)
+    query=db.session.query(*[getattr(Movies,f) for f in fields]).filter(*movies_filters(request)).order_by(Movies.id)
+    return stream_export('movies',fields,query,output)
+
+  @app.route('/movies/<int:movie_id>/actors')
+  @requires_auth('get:actors')
+  def get_movie_actors(movie_id):
+    if not exists(Movies,movie_id):
+      abort(404)
+    key,query,fields=cast_query(Movies)
+    rows=query.filter(key==movie_id).all()
+    return jsonify({
+      'actors': Rows(fields,rows),
+      'total_actors': len(rows)
+    })
+
+  @app.route('/actors/<int:actor_id>/movies')
+  @requires_auth('get:movies')
+  def get_actor_movies(actor_id):
+    if not exists(Actors,actor_id):
+      abort(404)
+    key,query,fields=cast_query(Actors)
+    rows=query.filter(key==actor_id).all()
+    return jsonify({
+      'movies': Rows(fields,rows),
+      'total_movies': len(rows)
+    })
+
+  @app.route('/movies/<int:movie_id>/actors',methods=['POST'])
+  @requires_auth('patch:movies')
+  def create_casting(movie_id):
+    if not exists(Movies,movie_id):
+      abort(404)
+    casting=request.get_json()
+    if casting==None or len(casting)==0:
+      abort(400)
+    if not valid_casting(casting): #actor_id, role, start_date and end_date (yyyy-mm-dd)
+      abort(400)
+    if not exists(Actors,casting['actor_id']):
+      abort(422)
+    start,end=parse_date(casting['start_date']),parse_date(casting['end_date'])
+    if double_booked(casting['actor_id'],movie_id,start,end): #already cast in another movie at that time
+      abort(422)
+
+    #the same role can't be given twice to an actor in a movie (unique index), a concurrent
+    #booking of the actor is rejected by the exclusion constraint on Postgres
+    try:
+      Castings(movie_id=movie_id,actor_id=casting['actor_id'],role=casting['role'],
+        start_date=start,end_date=end).insert()
+      return jsonify({
+        'success':True,
+        'inserted':casting['role'],
+        'total_castings':count_rows(Castings)
+      })
+    except:
+      abort(422)
     
   @app.route('/actors',methods=['POST'])
   @requires_auth('post:actors')
@@ -73,26 +397,17 @@ def create_app(test_config=None):
     elif len(actor)==0:
       abort(400)
     
-    if 'name' and 'age' and 'gender' not in actor: #request body must contain all necessary informations.
-      abort(400)
-    elif type(actor['age']) != int or  actor['gender'].lower() not in ['male','female']: #correct expected format
+    if not valid_actor(actor): #request body must contain all necessary informations in the correct expected format.
       abort(400)
 
-    #No repeated actors allowed:
-    actor_existance=Actors.query.filter(Actors.name==actor['name']).all() #actors can have same name
-    if len(actor_existance) != 0:
-      for a in actor_existance:
-        if a.age==actor['age']:
-          abort(422)
-
+    #No repeated actors allowed: the unique index on (name, age) rejects the insert with a 422
     try:
-      new_actor=Actors(name=actor['name'],age=actor['age'],gender=actor['gender'])
+      new_actor=Actors(name=actor['name'],age=actor['age'],gender=actor['gender'].lower())
       new_actor.insert()
-      actors=Actors.query.all()
       return jsonify({
         'success':True,
         'inserted':actor['name'],
-        'total_actors': len(actors)
+        'total_actors': count_rows(Actors)
       })
     except:
       abort(422)
@@ -107,35 +422,66 @@ def create_app(test_config=None):
       abort(400)
     #checking the correct format of the request body
 
-    if 'title' and 'release_date' not in movie: #request body must contain all necessary informations.
-      abort(400)
-    
-    try: #checking the format and the validity of the release date, must be yyyy-mm-dd
-      res = datetime.strptime(movie['release_date'], "%Y-%m-%d")
-    except:
+    if not valid_movie(movie): #request body must contain all necessary informations, the release date must be yyyy-mm-dd
       abort(400)
     
-    #No repeated movies allowed:
-    movie_existance=Movies.query.filter(Movies.title==movie['title']).all() #multiple movies can have same title
-    if len(movie_existance) != 0:
-      for m in movie_existance:
-        if m.release_date==movie['release_date']:
-          abort(422)
-    #####
+    #No repeated movies allowed: the unique index on (title, release_date) rejects the insert with a 422
     try:
-      new_movie=Movies(title=movie['title'],release_date=movie['release_date'])
+      new_movie=Movies(title=movie['title'],release_date=parse_date(movie['release_date']))
       new_movie.insert()
 
-      movies=Movies.query.all()
-
       return jsonify({
         'success':True,
         'inserted':movie['title'],
-        'total_actors': len(movies)
+        'total_actors': count_rows(Movies)
         })
     except:
       abort(422)
       
+  @app.route('/actors/bulk',methods=['POST'])
+  @requires_auth('post:actors')
+  def bulk_create_actors():
+    inserted,results=bulk_insert(Actors,bulk_records(request),valid_actor,actor_row,['name','age'])
+
+    return jsonify({
+      'success':True,
+      'inserted':inserted,
+      'results':results,
+      'total_actors':count_rows(Actors)
+    })
+
+  @app.route('/movies/bulk',methods=['POST'])
+  @requires_auth('post:movies')
+  def bulk_create_movies():
+    inserted,results=bulk_insert(Movies,bulk_records(request),valid_movie,movie_row,['title','release_date'])
+
+    return jsonify({
+      'success':True,
+      'inserted':inserted,
+      'results':results,
+      'total_movies':count_rows(Movies)
+    })
+      
+  @app.route('/actors/import',methods=['POST'])
+  @requires_auth('post:actors')
+  def import_actors():
+    records=upload_records(request,Actors) #text/csv or application/x-ndjson body, read as it arrives
+    try:
+      report=import_rows('actors',records)
+    except:
+      abort(422)
+    return jsonify(success=True,total_actors=count_rows(Actors),**report)
+
+  @app.route('/movies/import',methods=['POST'])
+  @requires_auth('post:movies')
+  def import_movies():
+    records=upload_records(request,Movies)
+    try:
+      report=import_rows('movies',records)
+    except:
+      abort(422)
+    return jsonify(success=True,total_movies=count_rows(Movies),**report)
+
   @app.route('/actors/<int:actor_id>',methods=['DELETE'])
   @requires_auth('delete:actors')
   def delete_actor(actor_id):
@@ -147,12 +493,10 @@ def create_app(test_config=None):
     try:
       actor.delete()
 
-      actors=Actors.query.all()
-
       return jsonify({
         'success':True,
         'deleted':actor_id,
-        'total_actors':len(actors)
+        'total_actors':count_rows(Actors)
       })
     except:
       abort(422)
@@ -169,12 +513,10 @@ def create_app(test_config=None):
     try:
       movie.delete()
 
-      movies=Movies.query.all()
-
       return jsonify({
         'success':True,
         'deleted':movie_id,
-        'total_movies':len(movies),
+        'total_movies':count_rows(Movies),
       })
     except:
       abort(422)
@@ -187,33 +529,17 @@ def create_app(test_config=None):
     if actor is None:
       abort(404)
     #Patching:
-    new_actor=request.get_json()
-
-    if new_actor==None :
-      abort(400)
-    elif len(new_actor)==0:
+    changes=actor_changes(request.get_json()) #name, age (integer) and gender (male or female)
+    if changes is None:
       abort(400)
-    
-    for attribute in new_actor:
-      if attribute=='name':
-        actor.name=new_actor['name']
-      elif attribute=='age':
-        if type(new_actor['age'])!= int :
-          abort(400)
-        actor.age=new_actor['age']
-      elif attribute=='gender':
-        if new_actor['gender'].lower() not in ['male','female']:
-          abort(400)
-        actor.gender=new_actor['gender']
-      else:
-        abort(400)
+    for column,value in changes.items():
+      setattr(actor,column,value)
     try:
       actor.update()
-      actors=Actors.query.all()
       return jsonify({
         'success':True,
         'updated':actor.id,
-        'total_actors':len(actors)
+        'total_actors':count_rows(Actors)
         })
     except:
       abort(422)
@@ -226,34 +552,83 @@ def create_app(test_config=None):
     if movie is None:
       abort(404)
     #Patching:
-    new_movie=request.get_json()
-    if new_movie==None: #empty body
-      abort(400)
-    elif len(new_movie)==0:
+    changes=movie_changes(request.get_json()) #title and release date (yyyy-mm-dd)
+    if changes is None:
       abort(400)
-    
-    for attribute in new_movie:
-      if attribute=='title':
-        movie.name=new_movie['title']
-      elif attribute=='release_date':
-        try: #checking the format and the validity of the release date, must be yyyy-mm-dd
-          res = datetime.strptime(new_movie['release_date'], "%Y-%m-%d")
-        except:
-          abort(400)
-        movie.release_date=new_movie['release_date']
-      else:
-        abort(400)
+    for column,value in changes.items():
+      setattr(movie,column,value)
     try:
       movie.update()
-      movies=Movies.query.all()
       return jsonify({
         'success':True,
         'updated':movie.id,
-        'total_movies':len(movies)
+        'total_movies':count_rows(Movies)
       })
     except:
       abort(422)
   
+  @app.route('/actors',methods=['PATCH'])
+  @requires_auth('patch:actors')
+  def batch_update_actors():
+    criteria,body=batch_criteria(request,Actors,actors_filters)
+    changes=actor_changes(body.get('changes'))
+    if changes is None:
+      abort(400)
+    try:
+      updated=batch_update(Actors,criteria,changes) #one UPDATE ... WHERE
+    except:
+      abort(422)
+    return jsonify({
+      'success':True,
+      'updated':updated,
+      'total_actors':count_rows(Actors)
+    })
+
+  @app.route('/movies',methods=['PATCH'])
+  @requires_auth('patch:movies')
+  def batch_update_movies():
+    criteria,body=batch_criteria(request,Movies,movies_filters)
+    changes=movie_changes(body.get('changes'))
+    if changes is None:
+      abort(400)
+    try:
+      updated=batch_update(Movies,criteria,changes)
+    except:
+      abort(422)
+    return jsonify({
+      'success':True,
+      'updated':updated,
+      'total_movies':count_rows(Movies)
+    })
+
+  @app.route('/actors',methods=['DELETE'])
+  @requires_auth('delete:actors')
+  def batch_delete_actors():
+    criteria,body=batch_criteria(request,Actors,actors_filters)
+    try:
+      deleted=batch_delete(Actors,criteria,Castings.actor_id) #one DELETE ... WHERE for the castings, one for the actors
+    except:
+      abort(422)
+    return jsonify({
+      'success':True,
+      'deleted':deleted,
+      'total_actors':count_rows(Actors)
+    })
+
+  @app.route('/movies',methods=['DELETE'])
+  @requires_auth('delete:movies')
+  def batch_delete_movies():
+    criteria,body=batch_criteria(request,Movies,movies_filters)
+    try:
+      deleted=batch_delete(Movies,criteria,Castings.movie_id)
+    except:
+      abort(422)
+    return jsonify({
+      'success':True,
+      'deleted':deleted,
+      'total_movies':count_rows(Movies)
+    })
+
   #### Errors Handlers #####
   @app.errorhandler(404)
   def not_found_404(error):
@@ -282,7 +657,15 @@ def create_app(test_config=None):
 
   return app
 
-app = create_app()
+#The app is created on first access (gunicorn app:app, flask, python app.py),
+#importing the module for create_app doesn't build one.
+def __getattr__(name):
+  global app
+  if name=='app':
+    app = create_app()
+    return app
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == '__main__':
-  app.run(debug=bool(os.environ['DEBUG']))
\ No newline at end of file
+  app = create_app()
+  app.run(debug=app.config['DEBUG'])
\ No newline at end of file
@@ -0,0 +1,58 @@
+import os
+import asyncio
+from a2wsgi import WSGIMiddleware
+from app import create_app
+from auth.auth import jwks_cache
+from auth.jwks import refresh_periodically
+
+########## ASGI entry point ##############
+'''
+Serves the app with an ASGI server (uvicorn asgi:app). The views stay
+synchronous: the WSGI app runs in a pool of ASGI_THREADS threads and a
+request holds a thread while its body is read, its queries run and its
+response is built, so the concurrency is bounded like a gthread worker.
+Idle keep-alive connections are held by the event loop only, and the
+signing keys are refreshed in the background instead of during a request.
+'''
+
+#threads running the views, by default as many as the database connections of the worker
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS',
+    int(os.environ.get('DB_POOL_SIZE', 5)) + int(os.environ.get('DB_MAX_OVERFLOW', 10))))
+
+
+class ASGIApp:
+
+    def __init__(self, wsgi_app, threads=ASGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.http = WSGIMiddleware(wsgi_app, workers=threads)
+        self.jwks_refresher = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        else:
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.jwks_refresher = asyncio.create_task(refresh_periodically(jwks_cache))
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.jwks_refresher is not None:
+                    self.jwks_refresher.cancel()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_asgi_app(threads=ASGI_THREADS):
+    return ASGIApp(create_app(), threads=threads)
+
+#created on first access (uvicorn asgi:app) like app.app, importing the module doesn't build one
+def __getattr__(name):
+    global app
+    if name == 'app':
+        app = create_asgi_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,14 +1,34 @@
-import json
-from flask import request, _request_ctx_stack,abort
+import os
+from flask import request, _request_ctx_stack,abort,g
 from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
+from auth.jwks import JWKSCache, url_fetcher
+from auth.token_cache import TokenCache
+from timing import timed
 
 
 AUTH0_DOMAIN = 'aymenfisher.eu.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'casting_agency'
 
+## JWKS cache
+'''
+The signing keys are fetched once and kept in memory instead of being
+downloaded on every request. Tests can swap the fetcher:
+    jwks_cache.fetcher = file_fetcher('jwks.json')
+'''
+JWKS_URL = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 3600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+jwks_cache = JWKSCache(url_fetcher(JWKS_URL), ttl=JWKS_CACHE_TTL, min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL)
+
+## Verified token cache
+'''
+Clients reuse the same token for hours, its payload is kept after the
+first verification until the token expires.
+'''
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+token_cache = TokenCache(maxsize=TOKEN_CACHE_SIZE)
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -72,8 +92,7 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    from jose import jwt #imported by the first verification, not at the boot of every worker
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -82,15 +101,22 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    try:
+        key = jwks_cache.get_key(unverified_header['kid'])
+    except Exception:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 401)
+
+    if key:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -125,20 +151,36 @@ def verify_decode_jwt(token):
             }, 400)
 
 
+def get_verified_payload(token):
+    ''' returns the cached payload of the token, the signature is only verified on a cache miss'''
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = verify_decode_jwt(token)
+        token_cache.set(token, payload)
+    return payload
+
+
 
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            try:
-                token = get_token_auth_header()
-                payload = verify_decode_jwt(token)
-            except:
-                abort(401)
-            try:
-                check_permissions(permission, payload)
-            except:
-                abort(403)
+            with timed('auth'):
+                try:
+                    token = get_token_auth_header()
+                    payload = get_verified_payload(token)
+                except AuthError as e:
+                    g.auth_error = e.error['code'] #reason of the failure for the metrics
+                    abort(401)
+                except:
+                    g.auth_error = 'invalid_token'
+                    abort(401)
+                try:
+                    check_permissions(permission, payload)
+                except AuthError as e:
+                    g.auth_error = e.error['code']
+                    abort(403)
+            g.jwt_payload = payload
             return f(*args, **kwargs)
 
         return wrapper
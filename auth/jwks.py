@@ -0,0 +1,120 @@
+import json
+import time
+import asyncio
+import logging
+from threading import Lock
+from urllib.request import urlopen
+
+logger = logging.getLogger(__name__)
+
+
+## JWKS fetchers
+'''
+A fetcher is any callable with no arguments returning the JWKS document
+as a dict ({'keys': [...]}). The url fetcher is used in production, the
+file fetcher lets tests and offline setups use a local JWKS file.
+'''
+
+
+def url_fetcher(url, timeout=5):
+    def fetch():
+        jsonurl = urlopen(url, timeout=timeout)
+        return json.loads(jsonurl.read())
+    return fetch
+
+
+def file_fetcher(path):
+    def fetch():
+        with open(path) as f:
+            return json.load(f)
+    return fetch
+
+
+## JWKS cache
+
+
+class JWKSCache:
+    """In-process cache of the signing keys indexed by their kid.
+
+    - keys are refetched once they are older than `ttl` seconds.
+    - an unknown kid (key rotation) triggers a refetch, at most once
+      every `min_refresh_interval` seconds.
+    - when a refetch fails the previous keys keep being served (stale
+      while revalidate), an error is only raised if nothing was ever fetched.
+    - concurrent requests share one fetch, the ones waiting for it don't fetch again.
+    """
+
+    def __init__(self, fetcher, ttl=3600, min_refresh_interval=30, clock=time.monotonic):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.clock = clock
+        self._keys = {}
+        self._fetched_at = None
+        self._attempted_at = None
+        self._lock = Lock()
+
+    def get_key(self, kid):
+        ''' returns the JWK of the given kid or None if the issuer does not know it'''
+        if self._fetched_at is None or self._expired(): #without keys, waits for a fetch in progress
+            self._refresh_if(self._expired)
+        if self._fetched_at is None:
+            raise RuntimeError('the signing keys could not be fetched, retried in %ss' % self.min_refresh_interval)
+        key = self._keys.get(kid)
+        if key is None and self._can_refresh():
+            self._refresh_if(lambda: kid not in self._keys and self._can_refresh())
+            key = self._keys.get(kid)
+        return key
+
+    def refresh(self):
+        with self._lock:
+            self._fetch()
+
+    def _refresh_if(self, needed):
+        ''' the requests waiting for the lock don't fetch again once another one fetched (or tried)'''
+        with self._lock:
+            if needed():
+                self._fetch()
+
+    def _fetch(self):
+        now = self.clock()
+        self._attempted_at = now
+        try:
+            jwks = self.fetcher()
+        except Exception:
+            if self._fetched_at is None:
+                raise
+            logger.warning('JWKS fetch failed, serving the cached keys', exc_info=True)
+            return
+        self._keys = {key['kid']: key for key in jwks['keys']}
+        self._fetched_at = now
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._attempted_at = None
+
+    def _expired(self):
+        # a failed fetch, even the first one, waits min_refresh_interval before being retried
+        if self._fetched_at is None:
+            return self._can_refresh()
+        return self.clock() - self._fetched_at >= self.ttl and self._can_refresh()
+
+    def _can_refresh(self):
+        return self._attempted_at is None or self.clock() - self._attempted_at >= self.min_refresh_interval
+
+
+async def refresh_periodically(cache, interval=None):
+    """Keeps the keys of the cache fresh from an event loop (ASGI lifespan).
+
+    The fetch runs in a thread so the loop keeps serving, and happens twice
+    per ttl so the requests never find expired keys and never wait for it.
+    """
+    interval = interval or max(cache.ttl / 2, cache.min_refresh_interval)
+    while True:
+        try:
+            await asyncio.to_thread(cache.refresh)
+        except Exception:
+            logger.warning('JWKS fetch failed', exc_info=True)
+        await asyncio.sleep(interval)
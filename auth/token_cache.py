@@ -0,0 +1,52 @@
+import time
+import hashlib
+from lru import LRUCache
+
+
+## Verified token cache
+
+
+class TokenCache:
+    """Bounded LRU cache of the payloads of already verified tokens.
+
+    Entries are keyed by a sha256 of the token (the raw token is never kept)
+    and expire at the token's `exp` claim, so a cached payload is never
+    served for an expired token.
+    """
+
+    def __init__(self, maxsize=1024, clock=time.time):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = LRUCache(maxsize, clock)
+
+    @staticmethod
+    def token_key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token):
+        payload = self._entries.get(self.token_key(token))
+        if payload is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return payload
+
+    def set(self, token, payload):
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)) or self.maxsize <= 0:
+            return
+        self._entries.set(self.token_key(token), payload, expires_at=exp)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses
+        }
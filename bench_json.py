@@ -0,0 +1,44 @@
+'''
+Microbenchmark of the encoding of a list of 10k actors.
+
+before: ORM entities -> format() dicts -> flask.jsonify (stdlib encoder)
+after:  result tuples -> Rows -> json_provider.jsonify (stdlib and orjson backends)
+
+Run it with: python bench_json.py
+'''
+import timeit
+from flask import Flask, jsonify as flask_jsonify
+from models import Actors
+from json_provider import jsonify, Rows, JSON_BACKENDS
+
+ACTORS = 10000
+REPEAT = 20
+
+def main():
+    app = Flask(__name__)
+    app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+    fields = Actors.FIELDS
+    rows = [(i, 'actor %d' % i, 20 + i % 60, 'male' if i % 2 else 'female') for i in range(ACTORS)]
+    entities = [Actors(id=i, name=name, age=age, gender=gender) for i, name, age, gender in rows]
+
+    def before():
+        return flask_jsonify({'actors': [a.format() for a in entities], 'total_actors': ACTORS})
+
+    results = {}
+    with app.app_context():
+        results['before (format() + flask.jsonify)'] = timeit.timeit(before, number=REPEAT)
+        for backend in JSON_BACKENDS:
+            app.config['JSON_BACKEND'] = backend
+
+            def after():
+                return jsonify({'actors': Rows(fields, rows), 'total_actors': ACTORS})
+
+            results['after (Rows + %s)' % backend] = timeit.timeit(after, number=REPEAT)
+
+    print('encoding %d actors, mean of %d runs' % (ACTORS, REPEAT))
+    for name, total in results.items():
+        print('%-40s %8.2f ms' % (name, total / REPEAT * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''
+Load test of GET /actors under the gunicorn profiles.
+
+Every profile starts gunicorn with gunicorn.conf.py and some environment
+overrides, then CLIENTS threads send requests over keep-alive connections
+for DURATION seconds. The baseline is the former Procfile (one sync worker).
+
+Needs the same environment as the app (DATABASE_URL, DEBUG) and a token
+with the get:actors permission:
+    export executive_producer="<executive producer JWT token>"
+    python bench_load.py [profile ...]
+'''
+import os
+import sys
+import time
+import http.client
+import subprocess
+import threading
+import importlib.util
+
+PORT = 8765
+CLIENTS = int(os.environ.get('BENCH_CLIENTS', 32))
+DURATION = int(os.environ.get('BENCH_DURATION', 15))
+PATH = '/actors?per_page=50'
+
+PROFILES = {
+    'baseline (1 sync worker)': {'WEB_CONCURRENCY': '1', 'GUNICORN_WORKER_CLASS': 'sync', 'GUNICORN_PRELOAD': 'false'},
+    'sync': {'GUNICORN_WORKER_CLASS': 'sync'},
+    'gthread': {'GUNICORN_WORKER_CLASS': 'gthread'},
+    'gevent': {'GUNICORN_WORKER_CLASS': 'gevent'},
+}
+
+def start_server(overrides):
+    env = dict(os.environ, PORT=str(PORT), **overrides)
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--access-logfile', os.devnull, 'app:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for i in range(100):
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', PORT, timeout=1)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('gunicorn did not start')
+
+def client(headers, deadline, latencies, errors):
+    connection = http.client.HTTPConnection('127.0.0.1', PORT, timeout=10)
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            connection.request('GET', PATH, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException):
+            errors.append('connection')
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', PORT, timeout=10)
+
+def run(overrides, headers):
+    server = start_server(overrides)
+    latencies, errors = [], []
+    try:
+        deadline = time.perf_counter() + DURATION
+        threads = [threading.Thread(target=client, args=(headers, deadline, latencies, errors)) for i in range(CLIENTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return latencies, errors
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def main():
+    headers = {'Authorization': 'Bearer {}'.format(os.environ['executive_producer'])}
+    names = sys.argv[1:] or list(PROFILES)
+    if importlib.util.find_spec('gevent') is None and 'gevent' in names:
+        print('gevent is not installed, skipping its profile')
+        names.remove('gevent')
+
+    print('GET %s, %d clients, %d seconds per profile' % (PATH, CLIENTS, DURATION))
+    print('%-26s %10s %10s %10s %8s' % ('profile', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for name in names:
+        latencies, errors = run(PROFILES[name], headers)
+        latencies.sort()
+        if not latencies:
+            print('%-26s %10s %10s %10s %8d' % (name, '-', '-', '-', len(errors)))
+            continue
+        print('%-26s %10.1f %10.2f %10.2f %8d' % (name, len(latencies) / DURATION,
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, len(errors)))
+
+
+if __name__ == '__main__':
+    main()
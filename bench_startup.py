@@ -0,0 +1,44 @@
+'''
+Startup time of a process serving the app (a gunicorn worker, a test run).
+
+Every case runs RUNS times in a fresh interpreter, the best time is kept
+and the time of an empty interpreter is subtracted. Without DATABASE_URL a temporary SQLite database is used.
+
+Run it with: python bench_startup.py
+'''
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+RUNS = 20
+
+CASES = {
+    'import app': 'import app',
+    'import app + create_app()': 'import app; app.create_app()',
+    'import app + create_app() + first request': (
+        'import app; a = app.create_app(); a.test_client().get("/actors")'),
+}
+
+def run(code, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], env=env, check=True)
+    return time.perf_counter() - start
+
+def best(code, env):
+    return min(run(code, env) for i in range(RUNS))
+
+def main():
+    env = dict(os.environ)
+    env.setdefault('DEBUG', 'false')
+    env.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'startup.db'))
+
+    interpreter = best('pass', env)
+    print('best of %d runs, minus %.1f ms of interpreter startup' % (RUNS, interpreter * 1000))
+    for name, code in CASES.items():
+        print('%-45s %8.1f ms' % (name, (best(code, env) - interpreter) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+import io
+import csv
+import json
+import click
+from itertools import islice
+from flask import abort
+from flask.cli import with_appcontext
+from models import db, record_write, Actors, Movies
+from validation import valid_actor, valid_movie, parse_date
+
+########## Bulk inserts ##############
+'''
+Records are processed by batches: every batch is validated, checked for
+duplicates with a single query and inserted with one executemany in its
+own transaction.
+'''
+
+BULK_BATCH_SIZE = 1000
+NDJSON_MIMETYPES = ['application/x-ndjson','application/ndjson']
+CSV_MIMETYPES = ['text/csv']
+
+def actor_row(actor):
+    return {'name':actor['name'],'age':actor['age'],'gender':actor['gender'].lower()}
+
+def movie_row(movie):
+    return {'title':movie['title'],'release_date':parse_date(movie['release_date'])}
+
+def bulk_records(request):
+    ''' returns an iterator over the records of a JSON array body or of an NDJSON stream'''
+    if request.mimetype in NDJSON_MIMETYPES:
+        return ndjson_records(request.stream)
+
+    records=request.get_json(silent=True)
+    if not isinstance(records,list) or len(records)==0:
+        abort(400)
+    return iter(records)
+
+def ndjson_records(stream):
+    ''' parses the stream line by line, an unparsable line gives a None record'''
+    for line in stream:
+        line=line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+def batches(iterable,size):
+    iterator=iter(iterable)
+    batch=list(islice(iterator,size))
+    while batch:
+        yield batch
+        batch=list(islice(iterator,size))
+
+def bulk_insert(model,records,validate,to_row,key_columns):
+    ''' inserts the valid and not repeated records, returns the number of inserted rows
+    and the result of every record ('inserted','invalid','duplicate' or 'error')'''
+    keys=[getattr(model,column) for column in key_columns]
+    seen=set() #keys already in the request
+    results=[]
+    inserted=0
+
+    for batch in batches(records,BULK_BATCH_SIZE):
+        candidates=[]
+        for record in batch:
+            result={'index':len(results),'status':'invalid'}
+            results.append(result)
+            if not validate(record):
+                continue
+            row=to_row(record)
+            key=tuple(row[column] for column in key_columns)
+            if key in seen:
+                result['status']='duplicate'
+                continue
+            seen.add(key)
+            candidates.append((key,row,result))
+
+        if len(candidates)==0:
+            continue
+
+        #one query for the duplicates of the whole batch
+        existing=set(tuple(r) for r in db.session.query(*keys).filter(
+            db.tuple_(*keys).in_([key for key,row,result in candidates])).all())
+
+        new=[]
+        for key,row,result in candidates:
+            if key in existing:
+                result['status']='duplicate'
+            else:
+                new.append((row,result))
+        if len(new)==0:
+            continue
+
+        try:
+            db.session.execute(model.__table__.insert(),[row for row,result in new])
+            record_write(model,len(new))
+            db.session.commit()
+            status='inserted'
+            inserted+=len(new)
+        except:
+            db.session.rollback()
+            status='error'
+        for row,result in new:
+            result['status']=status
+
+    return inserted,results
+
+
+########## Streaming imports ##############
+'''
+Roster files (CSV with a header line, or NDJSON) are parsed as they are read
+and their valid records are loaded into a temporary staging table, with
+COPY FROM STDIN on Postgres and batched inserts on the other databases. One
+INSERT ... SELECT ... ON CONFLICT DO NOTHING then merges the staging table
+into the real one, skipping the rows which already exist. The whole file is
+imported in one transaction.
+'''
+
+MAX_REPORTED_INVALID = 100
+
+#table -> model, validation, record to row, imported columns
+IMPORTS = {
+    'actors':(Actors,valid_actor,actor_row,['name','age','gender']),
+    'movies':(Movies,valid_movie,movie_row,['title','release_date'])
+}
+
+def csv_records(stream,model):
+    ''' parses a CSV byte stream with a header line, the values of the integer columns
+    are converted (an unconvertible value is left as it is and fails the validation)'''
+    integers=[column.name for column in model.__table__.columns if isinstance(column.type,db.Integer)]
+    for record in csv.DictReader(io.TextIOWrapper(stream,encoding='utf-8',newline='')):
+        for name in integers:
+            try:
+                record[name]=int(record[name])
+            except (KeyError,TypeError,ValueError):
+                pass
+        yield record
+
+def upload_records(request,model):
+    ''' returns an iterator over the records of a CSV or NDJSON request body'''
+    if request.mimetype in CSV_MIMETYPES:
+        return csv_records(request.stream,model)
+    if request.mimetype in NDJSON_MIMETYPES:
+        return ndjson_records(request.stream)
+    abort(400)
+
+class ChunksReader:
+    ''' file-like object reading an iterator of byte chunks, what COPY reads from'''
+
+    def __init__(self,chunks):
+        self.chunks=iter(chunks)
+        self.buffer=b''
+
+    def read(self,size=-1):
+        while size<0 or len(self.buffer)<size:
+            chunk=next(self.chunks,None)
+            if chunk is None:
+                break
+            self.buffer+=chunk
+        if size<0:
+            size=len(self.buffer)
+        data,self.buffer=self.buffer[:size],self.buffer[size:]
+        return data
+
+def csv_chunks(rows,columns):
+    for batch in batches(rows,BULK_BATCH_SIZE):
+        buffer=io.StringIO()
+        csv.writer(buffer,lineterminator='\n').writerows([row[column] for column in columns] for row in batch)
+        yield buffer.getvalue().encode()
+
+def staging_table(model,columns):
+    return db.Table('import_'+model.__tablename__.lower(),db.MetaData(),
+        *[db.Column(column,model.__table__.c[column].type) for column in columns],prefixes=['TEMPORARY'])
+
+def copy_rows(connection,staging,columns,rows):
+    ''' loads the rows with COPY FROM STDIN (psycopg2), streamed by chunks of BULK_BATCH_SIZE rows'''
+    quote=connection.dialect.identifier_preparer
+    sql='COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(quote.format_table(staging),
+        ','.join(quote.quote(column) for column in columns))
+    cursor=connection.connection.cursor()
+    try:
+        cursor.copy_expert(sql,ChunksReader(csv_chunks(rows,columns)))
+    finally:
+        cursor.close()
+
+def insert_rows(connection,staging,rows):
+    for batch in batches(rows,BULK_BATCH_SIZE):
+        connection.execute(staging.insert(),batch)
+
+def merge_statement(connection,model,staging,columns):
+    ''' INSERT ... SELECT of the staging rows, the ones breaking a unique index (existing
+    or repeated rows) are skipped'''
+    if connection.dialect.name=='postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    select=db.select([staging.c[column] for column in columns]).where(db.true())
+    return insert(model.__table__).from_select(columns,select).on_conflict_do_nothing()
+
+def import_rows(table,records):
+    ''' imports the records of the table ('actors' or 'movies'), returns the number of
+    inserted, duplicate and invalid records and the index of the first invalid ones'''
+    model,validate,to_row,columns=IMPORTS[table]
+    report={'inserted':0,'duplicates':0,'invalid':0,'invalid_records':[]}
+    loaded=0
+
+    def valid_rows():
+        nonlocal loaded
+        for index,record in enumerate(records):
+            if validate(record):
+                loaded+=1
+                yield to_row(record)
+                continue
+            report['invalid']+=1
+            if len(report['invalid_records'])<MAX_REPORTED_INVALID:
+                report['invalid_records'].append(index)
+
+    staging=staging_table(model,columns)
+    try:
+        connection=db.session.connection()
+        staging.drop(connection,checkfirst=True)
+        staging.create(connection)
+        if connection.dialect.name=='postgresql':
+            copy_rows(connection,staging,columns,valid_rows())
+        else:
+            insert_rows(connection,staging,valid_rows())
+        inserted=connection.execute(merge_statement(connection,model,staging,columns)).rowcount
+        staging.drop(connection)
+        if inserted:
+            record_write(model,inserted)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+    report['inserted']=inserted
+    report['duplicates']=loaded-inserted
+    return report
+
+@click.command('import-rows')
+@click.argument('table',type=click.Choice(list(IMPORTS)))
+@click.argument('path',type=click.Path(exists=True,dir_okay=False))
+@click.option('--format','file_format',type=click.Choice(['csv','ndjson']),
+    help='Format of the file, guessed from its extension by default.')
+@with_appcontext
+def import_command(table,path,file_format):
+    ''' imports the actors or movies of a CSV or NDJSON file'''
+    if file_format is None:
+        file_format='csv' if path.lower().endswith('.csv') else 'ndjson'
+    with open(path,'rb') as stream:
+        records=csv_records(stream,IMPORTS[table][0]) if file_format=='csv' else ndjson_records(stream)
+        report=import_rows(table,records)
+    click.echo('Imported {inserted} {table}, {duplicates} duplicates and {invalid} invalid records skipped.'.format(table=table,**report))
@@ -0,0 +1,72 @@
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+from flask import request, current_app, make_response, abort
+from models import table_state
+
+########## Conditional requests ##############
+'''
+List responses only change when their table is written, the ETag is built
+from the table version (bumped by insert/update/delete), the versions of the
+included tables and the request arguments. A client sending back the ETag (If-None-Match) or the
+Last-Modified date (If-Modified-Since) of an unchanged list gets a
+304 Not Modified, the table is not read and nothing is serialized.
+'''
+
+def request_models(model,includes):
+    ''' the model and the tables of the requested related data (include=cast),
+    an unknown include is a bad request'''
+    models=[model]
+    for name in request.args.get('include','').split(','):
+        if not name:
+            continue
+        if includes is None or name not in includes:
+            abort(400)
+        models+=[related for related in includes[name] if related not in models]
+    return models
+
+def table_etag(models,versions):
+    key=':'.join(f'{model.__tablename__}:{version}' for model,version in zip(models,versions))
+    key=f'{key}:{request.full_path}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def stable_last_modified(updated_at):
+    ''' HTTP dates have a one second precision: while the last write is in the current second,
+    a following write in the same second would get the same date, so there is no Last-Modified
+    until that second is over (the ETag is always sent)'''
+    last_modified=updated_at.replace(microsecond=0,tzinfo=timezone.utc)
+    if last_modified>=datetime.now(timezone.utc).replace(microsecond=0):
+        return None
+    return last_modified
+
+def not_modified(etag,last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified<=request.if_modified_since
+    return False
+
+def conditional(model,includes=None):
+    ''' includes: tables read by each include of the request ({'cast':[Castings,Actors]}),
+    a write to any of them changes the ETag'''
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            models=request_models(model,includes)
+            states=[table_state(m) for m in models]
+            etag=table_etag(models,[state.version for state in states])
+            last_modified=stable_last_modified(max(state.updated_at for state in states))
+
+            if not_modified(etag,last_modified):
+                response=current_app.response_class(status=304)
+            else:
+                response=make_response(f(*args, **kwargs))
+                if response.status_code!=200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified=last_modified
+            return response
+
+        return wrapper
+    return conditional_decorator
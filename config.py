@@ -2,13 +2,54 @@ import os
 
 
 #Debug mode.
-DEBUG = os.environ['DEBUG']
+DEBUG = os.environ['DEBUG'].lower() in ['true','1'] #'False' must not enable it
+
+#JSON encoder of the responses: 'orjson' (when installed), 'stdlib' or 'auto' for the fastest available.
+JSON_BACKEND = os.environ.get('JSON_BACKEND','auto')
 
 #Track modifications
 SQLALCHEMY_TRACK_MODIFICATIONS=False
 
 #DATABASE URL
-database_path = os.environ['DATABASE_URL']
-if database_path.startswith("postgres://"):
-    database_path = database_path.replace("postgres://", "postgresql://", 1)
-SQLALCHEMY_DATABASE_URI = database_path
\ No newline at end of file
+def database_uri(url):
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    return url
+
+database_path = database_uri(os.environ['DATABASE_URL'])
+SQLALCHEMY_DATABASE_URI = database_path
+
+#Read replicas (comma separated URLs) serving the queries of the GET requests, and seconds
+#before a replica which failed to connect is tried again.
+SQLALCHEMY_REPLICA_URIS = [database_uri(url.strip()) for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+REPLICA_RETRY_SECONDS = int(os.environ.get('REPLICA_RETRY_SECONDS', 30))
+
+#Connection pool of each worker (not used with SQLite): connections kept open, extra connections
+#allowed under load, seconds to wait for a free connection, seconds before a connection is
+#replaced (below the server idle timeout) and a liveness check of the connection on checkout.
+if not database_path.startswith('sqlite'):
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ['true','1'],
+    }
+
+#Response cache of the list endpoints: number of responses kept by each worker (0 disables it)
+#and their lifetime in seconds. RESPONSE_CACHE_URL (redis://...) shares the cache between the workers.
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL')
+
+#Request instrumentation: Server-Timing response header, level of the JSON request log lines
+#('WARNING' only keeps the slow patterns) and number of queries of a request logged as a likely N+1.
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'true').lower() in ['true','1']
+REQUEST_LOG_LEVEL = os.environ.get('REQUEST_LOG_LEVEL', 'INFO').upper()
+QUERY_COUNT_WARNING = int(os.environ.get('QUERY_COUNT_WARNING', 20))
+
+#Bearer token required by GET /metrics (Prometheus 'authorization' scrape setting), it is disabled when it isn't set.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+#Key of the /internal endpoints (X-Internal-Key header), they are disabled when it isn't set.
+INTERNAL_API_KEY = os.environ.get('INTERNAL_API_KEY')
@@ -0,0 +1,48 @@
+import io
+import csv
+from flask import abort, current_app, stream_with_context
+from json_provider import Rows, get_dumps
+from bulk import batches
+
+########## Exports ##############
+'''
+Full dumps of a table as NDJSON (one object per line) or CSV. The rows are
+read through a server-side cursor by batches of EXPORT_BATCH_SIZE and each
+batch is sent as soon as it is encoded: the first bytes leave right away and
+the memory used by the worker doesn't depend on the size of the table.
+'''
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_MIMETYPES = {'ndjson':'application/x-ndjson','csv':'text/csv'}
+
+def export_format(request):
+    ''' the format argument (ndjson or csv), ndjson by default'''
+    output=request.args.get('format','ndjson')
+    if output not in EXPORT_MIMETYPES:
+        abort(400)
+    return output
+
+def csv_lines(rows):
+    buffer=io.StringIO()
+    csv.writer(buffer,lineterminator='\n').writerows(rows)
+    return buffer.getvalue().encode()
+
+def stream_export(name,fields,query,output):
+    ''' streaming response of the rows of the query (the given fields, in that order), the query
+    is sent before returning so its errors are still regular error responses'''
+    if output=='csv':
+        encode=csv_lines
+    else:
+        dumps=get_dumps()
+        encode=lambda batch: Rows(fields,batch,skip=0).to_ndjson(dumps)
+    rows=iter(query.yield_per(EXPORT_BATCH_SIZE)) #stream_results: server-side cursor on Postgres
+
+    def generate():
+        if output=='csv':
+            yield csv_lines([fields])
+        for batch in batches(rows,EXPORT_BATCH_SIZE):
+            yield encode(batch)
+
+    response=current_app.response_class(stream_with_context(generate()),mimetype=EXPORT_MIMETYPES[output])
+    response.headers['Content-Disposition']=f'attachment; filename={name}.{output}'
+    return response
@@ -0,0 +1,89 @@
+'''
+Production profile of gunicorn, used by the Procfile: gunicorn -c gunicorn.conf.py app:app
+
+Every setting can be overridden from the environment:
+- WEB_CONCURRENCY: worker processes, 2 * CPUs + 1 by default.
+- GUNICORN_WORKER_CLASS: 'gthread' (default), 'gevent' (needs gevent, and psycogreen
+  so the database calls yield) or 'sync'. Select gevent with this variable rather than -k:
+  the standard library is patched here, before the master loads the app.
+- GUNICORN_THREADS: threads of a gthread worker, GUNICORN_WORKER_CONNECTIONS: greenlets of a gevent worker.
+- GUNICORN_PRELOAD: load the app once in the master before forking the workers ('true' by default).
+- PROMETHEUS_MULTIPROC_DIR: directory where the workers write their metrics, emptied at startup.
+Keep workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) below the max_connections of the database.
+'''
+import os
+
+#gevent must patch ssl, socket and threading before anything imports them: with preload_app the
+#master builds the app (JWKS fetches, locks, database pools) long before the worker would patch
+if os.environ.get('GUNICORN_WORKER_CLASS') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+import shutil
+import tempfile
+import multiprocessing
+
+#set before the app imports prometheus_client, the metrics of a previous run are dropped
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'casting_agency_metrics'))
+shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+
+#the app and its imports are loaded once and shared copy-on-write by the workers
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in ['true', '1']
+
+#idle connections kept open between requests (the load balancer reuses them) and pending connections queue
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+backlog = int(os.environ.get('GUNICORN_BACKLOG', 2048))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+
+#workers are replaced after some requests, the jitter avoids restarting them all at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = 200
+
+accesslog = '-'
+
+
+def dispose_engines(app):
+    ''' drops the pooled connections, a connection must never be shared by two processes'''
+    from models import db
+    with app.app_context():
+        db.engine.dispose()
+    replicas = app.extensions.get('replicas')
+    if replicas is not None:
+        for engine in replicas.engines:
+            engine.dispose()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid) #drops its live gauges
+
+
+def when_ready(server):
+    if server.cfg.worker_class_str == 'gevent' and os.environ.get('GUNICORN_WORKER_CLASS') != 'gevent':
+        server.log.warning('gevent was selected with -k, set GUNICORN_WORKER_CLASS=gevent so the app is loaded patched')
+    # the app doesn't connect while it is created, but anything which did in the master
+    # (an import, a hook) must not share its connections with the workers
+    if server.cfg.preload_app:
+        dispose_engines(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    if server.cfg.worker_class_str == 'gevent':
+        try:
+            from psycogreen.gevent import patch_psycopg #optional, makes psycopg2 cooperative
+            patch_psycopg()
+        except ImportError:
+            server.log.warning('psycogreen is not installed, database calls block the gevent workers')
+    if server.cfg.preload_app:
+        from pool_metrics import pool_metrics
+        dispose_engines(server.app.wsgi()) #new pool in the worker
+        pool_metrics.reset() #counters of the master
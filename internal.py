@@ -0,0 +1,51 @@
+import hmac
+from functools import wraps
+from flask import Blueprint, request, abort, current_app
+from json_provider import jsonify
+from models import db
+from pool_metrics import pool_metrics
+from auth.auth import token_cache
+
+########## Internal endpoints ##############
+'''
+Operational stats of a worker, for the team only: they need the
+INTERNAL_API_KEY in the X-Internal-Key header and don't exist without it.
+'''
+
+internal = Blueprint('internal', __name__, url_prefix='/internal')
+
+def requires_internal_key(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = current_app.config.get('INTERNAL_API_KEY')
+        if not key:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get('X-Internal-Key', ''), key):
+            abort(401)
+        return f(*args, **kwargs)
+    return wrapper
+
+
+@internal.route('/cache')
+@requires_internal_key
+def cache_stats():
+    cache = current_app.extensions.get('response_cache')
+    if cache is None:
+        abort(404)
+    return jsonify(cache.stats())
+
+
+@internal.route('/pool')
+@requires_internal_key
+def pool_stats():
+    stats = pool_metrics.stats(db.engine)
+    replicas = current_app.extensions.get('replicas')
+    if replicas is not None:
+        stats['replicas'] = replicas.stats()
+    return jsonify(stats)
+
+
+@internal.route('/tokens')
+@requires_internal_key
+def token_stats():
+    return jsonify(token_cache.stats())
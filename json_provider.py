@@ -0,0 +1,131 @@
+import json
+from datetime import date
+from json.encoder import encode_basestring_ascii
+from flask import current_app
+from timing import timed
+
+try:
+    import orjson
+except ImportError: #optional, the standard library encoder is used without it
+    orjson = None
+
+########## JSON responses ##############
+'''
+Responses are encoded by a pluggable backend: orjson when it is installed,
+the standard library otherwise (JSON_BACKEND='stdlib' or 'orjson' forces one).
+Rows coming from the database are wrapped in `Rows` and written directly
+from the result tuples, without building a dict per row.
+'''
+
+def stdlib_default(value):
+    if isinstance(value,date):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def stdlib_dumps(obj):
+    return json.dumps(obj,separators=(',',':'),default=stdlib_default).encode()
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj)
+
+JSON_BACKENDS = {'stdlib':stdlib_dumps}
+if orjson is not None:
+    JSON_BACKENDS['orjson'] = orjson_dumps
+
+def get_dumps():
+    backend=current_app.config.get('JSON_BACKEND','auto')
+    if backend=='auto':
+        backend='orjson' if orjson is not None else 'stdlib'
+    return JSON_BACKENDS[backend]
+
+
+#Rows:
+def encode_date(value):
+    return '"'+value.isoformat()+'"'
+
+VALUE_ENCODERS = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+    date: encode_date
+}
+
+def encode_value(value):
+    encoder=VALUE_ENCODERS.get(type(value))
+    if encoder is None:
+        return json.dumps(value,default=stdlib_default)
+    return encoder(value)
+
+class Rows:
+    ''' query result tuples of the given fields, the first `skip` columns of each
+    row (the id used for the pagination) are not part of the output. `related`
+    adds lists loaded separately to every row: {'cast': {row id: [...]}}'''
+
+    def __init__(self,fields,rows,compact=False,skip=1,related=None):
+        self.fields=fields
+        self.rows=rows
+        self.compact=compact
+        self.skip=skip
+        self.related=related or {}
+
+    def to_json(self,dumps):
+        if dumps is stdlib_dumps and not self.compact:
+            #each row fills an object template, no dict is built
+            template=self.template()
+            skip=self.skip
+            if not self.related:
+                return ('['+','.join(template % tuple(map(encode_value,row[skip:])) for row in self.rows)+']').encode()
+            related=self.related.values()
+            return ('['+','.join(template % (tuple(map(encode_value,row[skip:]))
+                +tuple(dumps(values.get(row[0],[])).decode() for values in related)) for row in self.rows)+']').encode()
+        #orjson builds its output in C, handing it the dicts is still the fastest
+        return dumps(self.to_python())
+
+    def to_ndjson(self,dumps):
+        ''' one object per line (NDJSON), the compact mode and the related lists don't apply'''
+        if dumps is stdlib_dumps:
+            template=self.template()
+            skip=self.skip
+            return ''.join(template % tuple(map(encode_value,row[skip:]))+'\n' for row in self.rows).encode()
+        return b''.join(dumps(dict(zip(self.fields,row[self.skip:])))+b'\n' for row in self.rows)
+
+    def template(self):
+        keys=list(self.fields)+list(self.related)
+        return '{'+','.join(encode_basestring_ascii(k).replace('%','%%')+':%s' for k in keys)+'}'
+
+    def to_python(self):
+        ''' the same data as plain lists and dicts'''
+        if self.compact:
+            columns={f:[row[i+self.skip] for row in self.rows] for i,f in enumerate(self.fields)}
+            for name,values in self.related.items():
+                columns[name]=[values.get(row[0],[]) for row in self.rows]
+            return columns
+        objects=[dict(zip(self.fields,row[self.skip:])) for row in self.rows]
+        for name,values in self.related.items():
+            for row,obj in zip(self.rows,objects):
+                obj[name]=values.get(row[0],[])
+        return objects
+
+
+def dumps_response(obj,dumps):
+    ''' encodes the response body, Rows values of the top level dict are spliced in as they are'''
+    if isinstance(obj,dict) and any(isinstance(v,Rows) for v in obj.values()):
+        items=[]
+        for key,value in obj.items():
+            encoded=value.to_json(dumps) if isinstance(value,Rows) else dumps(value)
+            items.append(dumps(key)+b':'+encoded)
+        return b'{'+b','.join(items)+b'}'
+    return dumps(obj)
+
+def jsonify(*args,**kwargs):
+    ''' drop-in replacement of flask.jsonify using the configured backend'''
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    elif len(args)==1:
+        data=args[0]
+    else:
+        data=args or kwargs
+    with timed('serialize'):
+        body=dumps_response(data,get_dumps())+b'\n'
+    return current_app.response_class(body,mimetype=current_app.config['JSONIFY_MIMETYPE'])
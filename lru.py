@@ -0,0 +1,44 @@
+from collections import OrderedDict
+from threading import Lock
+
+########## LRU cache ##############
+'''
+Bounded and thread safe mapping of the in-process caches (verified tokens,
+responses): an entry can have an expiry date and the least recently used
+entries are dropped beyond maxsize.
+'''
+
+class LRUCache:
+
+    def __init__(self,maxsize,clock):
+        self.maxsize=maxsize
+        self.clock=clock
+        self._entries=OrderedDict()
+        self._lock=Lock()
+
+    def get(self,key):
+        ''' the value of the key, None if it is missing or expired'''
+        with self._lock:
+            entry=self._entries.get(key)
+            if entry is None:
+                return None
+            value,expires_at=entry
+            if expires_at is not None and expires_at<=self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self,key,value,expires_at=None):
+        with self._lock:
+            self._entries[key]=(value,expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries)>self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
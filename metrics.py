@@ -0,0 +1,129 @@
+import os
+import time
+import hmac
+from flask import g, request, current_app, abort
+from prometheus_client import (Counter, Histogram, Gauge, CollectorRegistry, REGISTRY,
+    generate_latest, CONTENT_TYPE_LATEST, multiprocess)
+from pool_metrics import pool_metrics
+
+########## Prometheus metrics ##############
+'''
+Request counts and latencies per route, status codes, authentication
+failures, JWKS fetches and database pool usage, exposed in the Prometheus
+text format on GET /metrics.
+
+Under gunicorn every worker writes its values in PROMETHEUS_MULTIPROC_DIR
+(set by gunicorn.conf.py) and a scrape adds up the files of all the
+workers, whichever worker answers it.
+'''
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 10.0)
+
+REQUESTS = Counter('http_requests_total', 'HTTP requests', ['method', 'route', 'status'])
+LATENCY = Histogram('http_request_duration_seconds', 'Duration of the HTTP requests',
+    ['method', 'route'], buckets=LATENCY_BUCKETS)
+AUTH_FAILURES = Counter('auth_failures_total', 'Rejected requests by reason (AuthError code)', ['reason'])
+JWKS_FETCHES = Histogram('jwks_fetch_duration_seconds', 'Duration of the Auth0 signing keys fetches',
+    ['outcome'], buckets=LATENCY_BUCKETS)
+
+#pool usage of the live workers, added up
+POOL_SIZE = Gauge('db_pool_size', 'Connections kept by the pools', multiprocess_mode='livesum')
+POOL_CHECKED_OUT = Gauge('db_pool_checked_out', 'Connections in use', multiprocess_mode='livesum')
+POOL_OVERFLOW = Gauge('db_pool_overflow', 'Connections opened over the pool size', multiprocess_mode='livesum')
+POOL_CHECKOUTS = Counter('db_pool_checkouts_total', 'Connections taken from the pools')
+POOL_TIMEOUTS = Counter('db_pool_timeouts_total', 'Requests which got no connection in time')
+POOL_WAIT = Counter('db_pool_wait_seconds_total', 'Time spent waiting for a connection')
+
+POOL_SYNC_INTERVAL = 1.0 #seconds between two copies of the pool stats of a worker
+
+
+class PoolSync:
+    ''' copies the pool stats of the worker to the metrics, counters are increased by
+    their change since the previous copy'''
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.synced_at = None
+        self.last = {'checkouts': 0, 'timeouts': 0, 'wait_time_total': 0.0}
+
+    def __call__(self, force=False):
+        now = time.monotonic()
+        if not force and self.synced_at is not None and now - self.synced_at < POOL_SYNC_INTERVAL:
+            return
+        self.synced_at = now
+        stats = pool_metrics.stats(self.engine)
+        POOL_SIZE.set(stats.get('size', 0))
+        POOL_CHECKED_OUT.set(stats.get('checked_out', 0))
+        POOL_OVERFLOW.set(max(stats.get('overflow', 0), 0))
+        for name, counter in [('checkouts', POOL_CHECKOUTS), ('timeouts', POOL_TIMEOUTS), ('wait_time_total', POOL_WAIT)]:
+            delta = stats[name] - self.last[name]
+            if delta > 0: #the stats are reset in a new worker
+                counter.inc(delta)
+            self.last[name] = stats[name]
+
+
+def timed_fetcher(fetcher):
+    ''' wraps a JWKS fetcher to measure its duration'''
+    def fetch():
+        start = time.perf_counter()
+        try:
+            jwks = fetcher()
+        except Exception:
+            JWKS_FETCHES.labels('error').observe(time.perf_counter() - start)
+            raise
+        JWKS_FETCHES.labels('success').observe(time.perf_counter() - start)
+        return jwks
+    fetch.timed = True
+    return fetch
+
+
+def route():
+    ''' the url rule of the request (/actors/<int:actor_id>), not its path, keeps the number of series bounded'''
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+def start_request():
+    g.metrics_start = time.perf_counter()
+
+def record_request(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    REQUESTS.labels(request.method, route(), str(response.status_code)).inc()
+    LATENCY.labels(request.method, route()).observe(time.perf_counter() - start)
+    reason = g.get('auth_error')
+    if reason is not None:
+        AUTH_FAILURES.labels(reason).inc()
+    sync_pool = current_app.extensions.get('metrics_pool_sync')
+    if sync_pool is not None:
+        sync_pool()
+    return response
+
+
+def registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        collected = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collected)
+        return collected
+    return REGISTRY
+
+def metrics_endpoint():
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token: #like the internal endpoints, it doesn't exist without its key
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        abort(401)
+    sync_pool = current_app.extensions.get('metrics_pool_sync')
+    if sync_pool is not None:
+        sync_pool(force=True)
+    return current_app.response_class(generate_latest(registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app, engine=None, jwks_cache=None):
+    ''' records the requests of the app, the pool of the engine and the fetches of the JWKS cache'''
+    app.before_request(start_request)
+    app.after_request(record_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
+    if engine is not None:
+        app.extensions['metrics_pool_sync'] = PoolSync(engine)
+    if jwks_cache is not None and not getattr(jwks_cache.fetcher, 'timed', False):
+        jwks_cache.fetcher = timed_fetcher(jwks_cache.fetcher)
@@ -0,0 +1,31 @@
+"""TableCounts: number of rows of each table
+
+Revision ID: 1b0d9e2c4a6f
+Revises:
+Create Date: 2026-10-18 09:05:12.118406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1b0d9e2c4a6f'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the server used to create it when it started (db.create_all()), a database
+    # restored from casting_agency.sql doesn't have it
+    if 'TableCounts' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table('TableCounts',
+                    sa.Column('table_name', sa.String(), nullable=False),
+                    sa.Column('total', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('table_name'))
+
+
+def downgrade():
+    op.drop_table('TableCounts')
@@ -0,0 +1,51 @@
+"""unique indexes on Actors(name, age) and Movies(title, release_date)
+
+Revision ID: 3f1c2a9d7b4e
+Revises: 1b0d9e2c4a6f
+Create Date: 2026-10-18 10:12:31.482913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b4e'
+down_revision = '1b0d9e2c4a6f'
+branch_labels = None
+depends_on = None
+
+
+def index_exists(table, name):
+    inspector = sa.inspect(op.get_bind())
+    return name in [index['name'] for index in inspector.get_indexes(table)]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        # the writes of the running servers wait for the end of the migration,
+        # none of them can happen between the counts and the counters below
+        op.execute('LOCK TABLE "Actors", "Movies" IN SHARE MODE')
+
+    # repeated rows left by concurrent inserts would make the unique indexes fail,
+    # keep the oldest one
+    op.execute('DELETE FROM "Actors" WHERE age IS NOT NULL AND id NOT IN '
+               '(SELECT min(id) FROM "Actors" GROUP BY name, age)')
+    op.execute('DELETE FROM "Movies" WHERE release_date IS NOT NULL AND id NOT IN '
+               '(SELECT min(id) FROM "Movies" GROUP BY title, release_date)')
+
+    # row counters of the remaining rows
+    op.execute('DELETE FROM "TableCounts" WHERE table_name IN (\'Actors\', \'Movies\')')
+    op.execute('INSERT INTO "TableCounts" (table_name, total) SELECT \'Actors\', count(*) FROM "Actors"')
+    op.execute('INSERT INTO "TableCounts" (table_name, total) SELECT \'Movies\', count(*) FROM "Movies"')
+
+    # db.create_all() already creates them on a new database
+    if not index_exists('Actors', 'ix_actors_name_age'):
+        op.create_index('ix_actors_name_age', 'Actors', ['name', 'age'], unique=True)
+    if not index_exists('Movies', 'ix_movies_title_release_date'):
+        op.create_index('ix_movies_title_release_date', 'Movies', ['title', 'release_date'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_movies_title_release_date', table_name='Movies')
+    op.drop_index('ix_actors_name_age', table_name='Actors')
@@ -0,0 +1,47 @@
+"""version and last write date of each table in TableCounts
+
+Revision ID: 5a9e3c7d1f20
+Revises: c4e7a1b9d2f5
+Create Date: 2026-10-18 15:21:44.608172
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a9e3c7d1f20'
+down_revision = 'c4e7a1b9d2f5'
+branch_labels = None
+depends_on = None
+
+
+def column_names(table):
+    inspector = sa.inspect(op.get_bind())
+    if table not in inspector.get_table_names():
+        return None
+    return [column['name'] for column in inspector.get_columns(table)]
+
+
+def upgrade():
+    columns = column_names('TableCounts')
+    if columns is None:
+        # created with all its columns by db.create_all()
+        op.create_table('TableCounts',
+                        sa.Column('table_name', sa.String(), nullable=False),
+                        sa.Column('total', sa.Integer(), nullable=False),
+                        sa.Column('version', sa.Integer(), server_default='0', nullable=False),
+                        sa.Column('updated_at', sa.DateTime(), server_default=sa.func.now(), nullable=False),
+                        sa.PrimaryKeyConstraint('table_name'))
+        return
+    with op.batch_alter_table('TableCounts') as batch_op:
+        if 'version' not in columns:
+            batch_op.add_column(sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+        if 'updated_at' not in columns:
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(), server_default=sa.func.now(), nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('TableCounts') as batch_op:
+        batch_op.drop_column('updated_at')
+        batch_op.drop_column('version')
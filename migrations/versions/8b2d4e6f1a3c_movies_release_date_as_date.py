@@ -0,0 +1,45 @@
+"""store Movies.release_date as a DATE with a B-tree index
+
+Revision ID: 8b2d4e6f1a3c
+Revises: 3f1c2a9d7b4e
+Create Date: 2026-10-18 11:40:07.215604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2d4e6f1a3c'
+down_revision = '3f1c2a9d7b4e'
+branch_labels = None
+depends_on = None
+
+
+def index_exists(table, name):
+    inspector = sa.inspect(op.get_bind())
+    return name in [index['name'] for index in inspector.get_indexes(table)]
+
+
+def upgrade():
+    # the dates were validated as yyyy-mm-dd before being stored as text. SQLite stores
+    # the dates as that text anyway, and its CAST(... AS DATE) would keep only the year
+    if op.get_bind().dialect.name != 'sqlite':
+        with op.batch_alter_table('Movies') as batch_op:
+            batch_op.alter_column('release_date',
+                                  existing_type=sa.String(),
+                                  type_=sa.Date(),
+                                  postgresql_using='release_date::date')
+
+    if not index_exists('Movies', 'ix_movies_release_date'):
+        op.create_index('ix_movies_release_date', 'Movies', ['release_date'])
+
+
+def downgrade():
+    op.drop_index('ix_movies_release_date', table_name='Movies')
+    if op.get_bind().dialect.name != 'sqlite':
+        with op.batch_alter_table('Movies') as batch_op:
+            batch_op.alter_column('release_date',
+                                  existing_type=sa.Date(),
+                                  type_=sa.String(),
+                                  postgresql_using='release_date::text')
@@ -0,0 +1,39 @@
+"""indexes for the gender, age and name filters of Actors
+
+Revision ID: c4e7a1b9d2f5
+Revises: 8b2d4e6f1a3c
+Create Date: 2026-10-18 13:05:52.930417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e7a1b9d2f5'
+down_revision = '8b2d4e6f1a3c'
+branch_labels = None
+depends_on = None
+
+
+def index_exists(table, name):
+    inspector = sa.inspect(op.get_bind())
+    return name in [index['name'] for index in inspector.get_indexes(table)]
+
+
+def upgrade():
+    # genders are stored lower case so the filter can use the index
+    op.execute('UPDATE "Actors" SET gender = lower(gender) WHERE gender <> lower(gender)')
+
+    if not index_exists('Actors', 'ix_actors_gender_age'):
+        op.create_index('ix_actors_gender_age', 'Actors', ['gender', 'age'])
+    if not index_exists('Actors', 'ix_actors_lower_name'):
+        if op.get_bind().dialect.name == 'postgresql':
+            op.execute('CREATE INDEX ix_actors_lower_name ON "Actors" (lower(name) text_pattern_ops)')
+        else:
+            op.execute('CREATE INDEX ix_actors_lower_name ON "Actors" (lower(name))')
+
+
+def downgrade():
+    op.drop_index('ix_actors_lower_name', table_name='Actors')
+    op.drop_index('ix_actors_gender_age', table_name='Actors')
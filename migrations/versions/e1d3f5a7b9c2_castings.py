@@ -0,0 +1,39 @@
+"""Castings: roles of the actors in the movies
+
+Revision ID: e1d3f5a7b9c2
+Revises: 5a9e3c7d1f20
+Create Date: 2026-10-18 19:32:10.482913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1d3f5a7b9c2'
+down_revision = '5a9e3c7d1f20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Castings',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('movie_id', sa.Integer(), nullable=False),
+                    sa.Column('actor_id', sa.Integer(), nullable=False),
+                    sa.Column('role', sa.String(), nullable=False),
+                    sa.Column('start_date', sa.Date(), nullable=False),
+                    sa.Column('end_date', sa.Date(), nullable=False),
+                    sa.ForeignKeyConstraint(['actor_id'], ['Actors.id'], ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(['movie_id'], ['Movies.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_castings_movie_actor_role', 'Castings', ['movie_id', 'actor_id', 'role'], unique=True)
+    op.create_index('ix_castings_actor_id', 'Castings', ['actor_id'])
+    op.execute('INSERT INTO "TableCounts" (table_name, total) VALUES (\'Castings\', 0)')
+
+
+def downgrade():
+    op.execute('DELETE FROM "TableCounts" WHERE table_name = \'Castings\'')
+    op.drop_index('ix_castings_actor_id', table_name='Castings')
+    op.drop_index('ix_castings_movie_actor_role', table_name='Castings')
+    op.drop_table('Castings')
@@ -0,0 +1,39 @@
+"""no overlapping castings of an actor in two movies (Postgres exclusion constraint)
+
+Revision ID: f2b4d6e8a0c1
+Revises: e1d3f5a7b9c2
+Create Date: 2026-10-18 20:02:37.915204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b4d6e8a0c1'
+down_revision = 'e1d3f5a7b9c2'
+branch_labels = None
+depends_on = None
+
+
+def constraint_exists(name):
+    return op.get_bind().execute(
+        sa.text('SELECT 1 FROM pg_constraint WHERE conname = :name'), {'name': name}).first() is not None
+
+
+def upgrade():
+    # SQLite has no range types, the application check is the only one there
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    if constraint_exists('castings_no_double_booking'): # created with the table by db.create_all()
+        return
+    # fails if some actors are already double booked, these castings must be fixed first
+    op.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+    op.execute('ALTER TABLE "Castings" ADD CONSTRAINT castings_no_double_booking EXCLUDE USING gist '
+               '(actor_id WITH =, daterange(start_date, end_date, \'[]\') WITH &&, movie_id WITH <>)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('ALTER TABLE "Castings" DROP CONSTRAINT IF EXISTS castings_no_double_booking')
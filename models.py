@@ -1,54 +1,218 @@
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+import click
+from flask import request, has_request_context
+from flask.cli import with_appcontext
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm, inspect, DDL
+from sqlalchemy.sql import Select
+from sqlalchemy.pool import QueuePool
+from datetime import datetime
+from threading import Lock
 import os
+import time
+from pool_metrics import pool_metrics, TimedQueuePool
 
-db=SQLAlchemy()
+
+########## Read replicas ##############
+'''
+With DATABASE_REPLICA_URLS, the queries of the GET requests go to the replicas
+(round-robin), everything else goes to the primary. A session which wrote
+sticks to the primary until the end of its request so it reads its own writes.
+A replica failing to connect is ejected for REPLICA_RETRY_SECONDS, the reads go
+to the other replicas or to the primary meanwhile.
+'''
+
+READ_METHODS=['GET','HEAD']
+
+class ReplicaRouter:
+
+    def __init__(self, engines, retry_after=30, clock=time.monotonic):
+        self.engines=engines
+        self.retry_after=retry_after
+        self.clock=clock
+        self.ejected={} #engine -> time it can be retried
+        self._next=0
+        self._lock=Lock()
+        for engine in engines:
+            event.listen(engine,'handle_error',self.on_error)
+
+    def on_error(self, context):
+        if context.is_disconnect or context.connection is None: #lost or refused connection
+            self.eject(context.engine)
+
+    def eject(self, engine):
+        with self._lock:
+            self.ejected[engine]=self.clock()+self.retry_after
+
+    def healthy(self, engine):
+        with self._lock:
+            return engine not in self.ejected
+
+    def choose(self):
+        ''' returns the next replica which isn't ejected, None if there is none. The replicas are
+        not checked before their reads (the failures eject them), only the ones coming back after
+        their REPLICA_RETRY_SECONDS are checked once'''
+        with self._lock:
+            start=self._next
+            self._next=(self._next+1)%len(self.engines)
+        for i in range(len(self.engines)):
+            engine=self.engines[(start+i)%len(self.engines)]
+            with self._lock:
+                retry_at=self.ejected.get(engine)
+            if retry_at is None:
+                return engine
+            if retry_at>self.clock():
+                continue
+            try:
+                engine.connect().close()
+            except:
+                self.eject(engine)
+                continue
+            with self._lock:
+                self.ejected.pop(engine,None)
+            return engine
+        return None
+
+    def stats(self):
+        return [{'url':engine.url.render_as_string(hide_password=True),'healthy':self.healthy(engine)}
+            for engine in self.engines]
+
+
+class RoutingSession(SignallingSession):
+    ''' session sending the reads of the GET requests to a replica'''
+
+    def __init__(self, db, **options):
+        self.wrote=False
+        self.replica=None #one replica per session, for consistent reads
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        router=self.app.extensions.get('replicas')
+        if router is not None and self.reads_from_replica(clause):
+            if self.replica is None or not router.healthy(self.replica):
+                self.replica=router.choose()
+            if self.replica is not None:
+                return self.replica
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def reads_from_replica(self, clause):
+        if self._flushing or (clause is not None and not isinstance(clause, Select)):
+            self.wrote=True
+        if self.wrote:
+            return False
+        return has_request_context() and request.method in READ_METHODS
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db=RoutingSQLAlchemy()
+
+def setup_replicas(app):
+    ''' creates the engines of the replicas, they use the pool options of the primary but not
+    its timed pool class, the pool metrics are the ones of the primary'''
+    urls=app.config.get('SQLALCHEMY_REPLICA_URIS')
+    if not urls or 'replicas' in app.extensions:
+        return
+    options=dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS',{}))
+    if options.get('poolclass') is TimedQueuePool:
+        options['poolclass']=QueuePool
+    engines=[create_engine(url,**options) for url in urls]
+    app.extensions['replicas']=ReplicaRouter(engines,retry_after=app.config.get('REPLICA_RETRY_SECONDS',30))
+
+def replica_engines(app):
+    replicas=app.extensions.get('replicas')
+    return replicas.engines if replicas is not None else []
 
 def setup_db(app):
-    ''' configure the app and setup the database'''
+    ''' configure the app and the database connection, nothing is sent to the database:
+    the tables are created by `flask create-db` and changed by `flask db upgrade`'''
     app.config.from_pyfile('config.py')
+    engine_options=app.config.get('SQLALCHEMY_ENGINE_OPTIONS',{})
+    if 'pool_size' in engine_options: #queue pool, time the waits for a connection
+        engine_options.setdefault('poolclass',TimedQueuePool)
     db.app = app
     db.init_app(app)
+    pool_metrics.attach(db.engine)
+    setup_replicas(app)
+    app.cli.add_command(create_db_command)
+    from bulk import import_command #bulk imports the models
+    app.cli.add_command(import_command)
+    if os.environ.get('FLASK_RUN_FROM_CLI')=='true': #flask db ... commands, alembic is slow to import
+        from flask_migrate import Migrate
+        migrate=Migrate(app,db)
+
+@click.command('create-db')
+@with_appcontext
+def create_db_command():
+    ''' creates the tables of an empty database in their latest version and marks the
+    migrations as applied, an existing database (casting_agency.sql) is migrated instead'''
+    from flask_migrate import stamp, upgrade
+    if 'Actors' in inspect(db.engine).get_table_names():
+        upgrade()
+        click.echo('The tables already exist, applied the migrations.')
+        return
     db.create_all()
-    migrate=Migrate(app,db)
+    seed_counters()
+    stamp()
+    click.echo('Created the database tables.')
 
 ########## Models ##############
 
 class Movies(db.Model):
     __tablename__="Movies"
+    FIELDS=['title','release_date'] #fields returned by the API
+    __table_args__=(
+        db.Index('ix_movies_title_release_date','title','release_date',unique=True), #no repeated movies
+        db.Index('ix_movies_release_date','release_date'), #range filters and sort by release date
+    )
     
     id=db.Column(db.Integer,primary_key=True)
     title=db.Column(db.String(),nullable=False)
-    release_date=db.Column(db.String())
+    release_date=db.Column(db.Date)
 
     def insert(self):
         try:
             db.session.add(self)
+            record_write(self.__class__,1)
             db.session.commit()
         except:
             db.session.rollback()
+            raise
     
     def delete(self):
         try:
+            delete_castings(Castings.movie_id==self.id)
             db.session.delete(self)
+            record_write(self.__class__,-1)
             db.session.commit()
         except:
             db.session.rollback()
+            raise
     
     def update(self):
         try:
+            record_write(self.__class__)
             db.session.commit()
         except:
             db.session.rollback()
+            raise
     
     def format(self):
         return {
             'title':self.title,
-            'release_date':self.release_date
+            'release_date':self.release_date.isoformat() if self.release_date else None
         }
 
 class Actors(db.Model):
     __tablename__='Actors'
+    FIELDS=['name','age','gender'] #fields returned by the API
+    __table_args__=(
+        db.Index('ix_actors_name_age','name','age',unique=True), #no repeated actors
+        db.Index('ix_actors_gender_age','gender','age'), #gender and age range filters
+    )
 
     id=db.Column(db.Integer,primary_key=True)
     name=db.Column(db.String(),nullable=False)
@@ -58,22 +222,29 @@ class Actors(db.Model):
     def insert(self):
         try:
             db.session.add(self)
+            record_write(self.__class__,1)
             db.session.commit()
         except:
             db.session.rollback()
+            raise
     
     def delete(self):
         try:
+            delete_castings(Castings.actor_id==self.id)
             db.session.delete(self)
+            record_write(self.__class__,-1)
             db.session.commit()
         except:
             db.session.rollback()
+            raise
     
     def update(self):
         try:
+            record_write(self.__class__)
             db.session.commit()
         except:
             db.session.rollback()
+            raise
     
     def format(self):
         return {
@@ -81,3 +252,147 @@ class Actors(db.Model):
             'age':self.age,
             'gender':self.gender
         }
+
+class Castings(db.Model):
+    ''' role of an actor in a movie, from start_date to end_date (both included),
+    deleted with its actor or its movie'''
+    __tablename__='Castings'
+    FIELDS=['role','start_date','end_date'] #fields returned by the API
+    __table_args__=(
+        db.Index('ix_castings_movie_actor_role','movie_id','actor_id','role',unique=True), #cast of a movie
+        db.Index('ix_castings_actor_id','actor_id'), #movies of an actor
+    )
+
+    id=db.Column(db.Integer,primary_key=True)
+    movie_id=db.Column(db.Integer,db.ForeignKey('Movies.id',ondelete='CASCADE'),nullable=False)
+    actor_id=db.Column(db.Integer,db.ForeignKey('Actors.id',ondelete='CASCADE'),nullable=False)
+    role=db.Column(db.String(),nullable=False)
+    start_date=db.Column(db.Date,nullable=False)
+    end_date=db.Column(db.Date,nullable=False)
+
+    def insert(self):
+        try:
+            db.session.add(self)
+            record_write(self.__class__,1)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+    def format(self):
+        return {
+            'role':self.role,
+            'start_date':self.start_date.isoformat(),
+            'end_date':self.end_date.isoformat()
+        }
+
+#an actor can't be in two movies at the same time: exclusion constraint on the date ranges of
+#each actor (Postgres only), its GiST index also serves the availability queries
+event.listen(Castings.__table__,'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS btree_gist').execute_if(dialect='postgresql'))
+event.listen(Castings.__table__,'after_create',
+    DDL('ALTER TABLE "Castings" ADD CONSTRAINT castings_no_double_booking EXCLUDE USING gist '
+        '(actor_id WITH =, daterange(start_date, end_date, \'[]\') WITH &&, movie_id WITH <>)').execute_if(dialect='postgresql'))
+
+def overlapping(start,end):
+    ''' criterion of the castings overlapping [start, end] (both included), written as a range
+    overlap on Postgres so the GiST index is used'''
+    if db.engine.dialect.name=='postgresql':
+        return db.func.daterange(Castings.start_date,Castings.end_date,'[]').op('&&')(
+            db.func.daterange(start,end,'[]'))
+    return db.and_(Castings.start_date<=end,Castings.end_date>=start)
+
+def double_booked(actor_id,movie_id,start,end):
+    ''' checks if the actor is cast in another movie during [start, end], the exclusion
+    constraint is the guarantee on Postgres, this check is the only one on SQLite'''
+    return db.session.query(Castings.id).filter(Castings.actor_id==actor_id,Castings.movie_id!=movie_id,
+        overlapping(start,end)).first() is not None
+
+def delete_castings(criterion):
+    ''' deletes the castings of a deleted actor or movie in the same transaction, the foreign
+    keys would cascade too but the castings counter must follow'''
+    deleted=Castings.query.filter(criterion).delete(synchronize_session=False)
+    if deleted:
+        record_write(Castings,-deleted)
+
+def batch_update(model,criteria,changes):
+    ''' updates the rows matching the criteria with a single UPDATE, returns their number'''
+    try:
+        updated=model.query.filter(*criteria).update(changes,synchronize_session=False)
+        if updated:
+            record_write(model)
+        db.session.commit()
+        return updated
+    except:
+        db.session.rollback()
+        raise
+
+def batch_delete(model,criteria,cast_key):
+    ''' deletes the rows matching the criteria and their castings (cast_key: Castings.movie_id
+    or Castings.actor_id) with a single DELETE each, in one transaction, returns their number'''
+    try:
+        delete_castings(cast_key.in_(db.session.query(model.id).filter(*criteria)))
+        deleted=model.query.filter(*criteria).delete(synchronize_session=False)
+        if deleted:
+            record_write(model,-deleted)
+        db.session.commit()
+        return deleted
+    except:
+        db.session.rollback()
+        raise
+
+#name prefix search (LIKE 'abc%'), text_pattern_ops makes it usable whatever the collation is
+db.Index('ix_actors_lower_name',db.func.lower(Actors.name).label('lower_name'),
+    postgresql_ops={'lower_name':'text_pattern_ops'})
+
+
+########## Row counters and table versions ##############
+
+class TableCounts(db.Model):
+    ''' number of rows and version of each table, updated in the same transaction as the writes
+    so the totals returned by the endpoints don't need to scan the table, and the version
+    tells the clients if a list changed (ETag) without reading it'''
+    __tablename__='TableCounts'
+
+    table_name=db.Column(db.String(),primary_key=True)
+    total=db.Column(db.Integer,nullable=False)
+    version=db.Column(db.Integer,nullable=False,default=0,server_default='0')
+    updated_at=db.Column(db.DateTime,nullable=False,default=datetime.utcnow,server_default=db.func.now())
+
+def table_state(model):
+    ''' returns the counter row of the model's table'''
+    counter=TableCounts.query.get(model.__tablename__)
+    if counter is None:
+        return seed_count(model)
+    return counter
+
+def count_rows(model):
+    ''' returns the number of rows of the model's table'''
+    return table_state(model).total
+
+def seed_count(model):
+    ''' initializes a missing counter with a count(*), the writes fail without their counter
+    (record_write) so none can commit between the count and the counter'''
+    total=db.session.query(db.func.count(model.id)).scalar()
+    try:
+        db.session.add(TableCounts(table_name=model.__tablename__,total=total,version=0,updated_at=datetime.utcnow()))
+        db.session.commit()
+    except:
+        db.session.rollback() #another worker seeded it first
+    return TableCounts.query.get(model.__tablename__)
+
+def seed_counters():
+    ''' creates the counters of the tables, done with the schema (create-db and the migrations)'''
+    for model in [Movies,Actors,Castings]:
+        if TableCounts.query.get(model.__tablename__) is None:
+            seed_count(model)
+
+def record_write(model,delta=0):
+    ''' adds delta to the counter of the model's table and bumps its version,
+    must run before the commit of the write, which fails if the counter is missing'''
+    updated=TableCounts.query.filter(TableCounts.table_name==model.__tablename__).update(
+        {TableCounts.total:TableCounts.total+delta,
+        TableCounts.version:TableCounts.version+1,
+        TableCounts.updated_at:datetime.utcnow()},synchronize_session=False)
+    if updated==0:
+        raise RuntimeError(f'no row counter for the {model.__tablename__} table, run `flask db upgrade`')
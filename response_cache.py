@@ -0,0 +1,123 @@
+import time
+import hashlib
+from functools import wraps
+from flask import request, current_app, g
+from models import table_state
+from conditional import request_models
+from lru import LRUCache
+
+########## Response cache ##############
+'''
+Cache of the list responses keyed by (endpoint, arguments, permissions,
+table version). Every insert/update/delete bumps the version of its table,
+so the entries of a written table are never served again, in every worker,
+and age out of the cache. The table is neither read nor serialized on a hit.
+'''
+
+#Backends:
+class LocalBackend(LRUCache):
+    ''' in-process LRU, each gunicorn worker has its own'''
+
+    def __init__(self,maxsize=512,clock=time.monotonic):
+        super().__init__(maxsize,clock)
+
+    def set(self,key,value,ttl=None):
+        super().set(key,value,expires_at=self.clock()+ttl if ttl else None)
+
+class SharedBackend:
+    ''' cache shared by all the workers in a key/value server, the client only needs
+    get(key) and set(key,value,ex=seconds) (a redis.Redis client), the values are
+    (body,mimetype) pairs stored as the mimetype line followed by the body'''
+
+    def __init__(self,client,prefix='casting_agency:responses:'):
+        self.client=client
+        self.prefix=prefix
+
+    def get(self,key):
+        value=self.client.get(self.prefix+key)
+        if value is None:
+            return None
+        mimetype,body=value.split(b'\n',1)
+        return body,mimetype.decode()
+
+    def set(self,key,value,ttl=None):
+        body,mimetype=value
+        self.client.set(self.prefix+key,mimetype.encode()+b'\n'+body,ex=ttl)
+
+class DictClient:
+    ''' local stand-in of a key/value server for SharedBackend (tests, single process)'''
+
+    def __init__(self):
+        self.data={}
+
+    def get(self,key):
+        return self.data.get(key)
+
+    def set(self,key,value,ex=None):
+        self.data[key]=value
+
+#Cache:
+class ResponseCache:
+
+    def __init__(self,backend,ttl=300):
+        self.backend=backend
+        self.ttl=ttl
+        self.hits=0
+        self.misses=0
+
+    def stats(self):
+        lookups=self.hits+self.misses
+        return {
+            'hits':self.hits,
+            'misses':self.misses,
+            'hit_ratio':self.hits/lookups if lookups else 0.0
+        }
+
+def response_key(models,versions):
+    payload=getattr(g,'jwt_payload',None) or {}
+    permissions=','.join(sorted(payload.get('permissions',[])))
+    tables=':'.join(f'{model.__tablename__}:{version}' for model,version in zip(models,versions))
+    key=f'{request.endpoint}:{request.full_path}:{permissions}:{tables}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def init_response_cache(app):
+    ''' creates the cache of the app from its config'''
+    url=app.config.get('RESPONSE_CACHE_URL')
+    size=app.config.get('RESPONSE_CACHE_SIZE',512)
+    if not url and size<=0: #disabled
+        return
+    if url:
+        import redis #optional, only needed for a shared cache
+        backend=SharedBackend(redis.Redis.from_url(url))
+    else:
+        backend=LocalBackend(maxsize=size)
+    app.extensions['response_cache']=ResponseCache(backend,ttl=app.config.get('RESPONSE_CACHE_TTL',300))
+
+def cached(model,includes=None):
+    ''' includes: tables read by each include of the request, see conditional()'''
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            cache=current_app.extensions.get('response_cache')
+            if cache is None:
+                return f(*args, **kwargs)
+
+            models=request_models(model,includes)
+            key=response_key(models,[table_state(m).version for m in models])
+            entry=cache.backend.get(key)
+            if entry is not None:
+                cache.hits+=1
+                body,mimetype=entry
+                response=current_app.response_class(body,mimetype=mimetype)
+                response.headers['X-Cache']='HIT'
+                return response
+
+            cache.misses+=1
+            response=current_app.make_response(f(*args, **kwargs))
+            if response.status_code==200:
+                cache.backend.set(key,(response.get_data(),response.mimetype),ttl=cache.ttl)
+            response.headers['X-Cache']='MISS'
+            return response
+
+        return wrapper
+    return cached_decorator
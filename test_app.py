@@ -1,10 +1,28 @@
 import os
 import unittest
 import json
+import tempfile
+import time
+import threading
+from datetime import date, datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
 
 from app import create_app
-from models import Movies,Actors,setup_db
+from models import db,Movies,Actors,Castings,count_rows,record_write,RoutingSQLAlchemy,setup_replicas
+from auth.jwks import JWKSCache, file_fetcher, refresh_periodically
+from auth.token_cache import TokenCache
+from json_provider import jsonify, Rows, JSON_BACKENDS
+from bulk import ChunksReader
+from flask import Flask
+from response_cache import LocalBackend, SharedBackend, DictClient, ResponseCache
+from pool_metrics import pool_metrics, TimedQueuePool
+from sqlalchemy import create_engine, exc, text, event
+import asyncio
+from asgi import ASGIApp
+import timing
+import metrics
+from auth.auth import requires_auth
+from conditional import stable_last_modified
 
 
 class CastingAgencyTestCase(unittest.TestCase):
@@ -14,7 +32,6 @@ class CastingAgencyTestCase(unittest.TestCase):
         """Define test variables and initialize app."""
         self.app = create_app()
         self.client = self.app.test_client
-        setup_db(self.app)
         #tokens for getting access:
         self.casting_assistant=os.environ['casting_assistant']
         self.casting_director=os.environ['casting_director']
@@ -145,6 +162,122 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['total_actors'], len(actors))
         self.assertEqual(len(data['actors']), 10)
     
+    def test_success_paginate_actors_per_page(self):
+        '''tests if the per_page argument changes the page size of actors'''
+        res=self.client().get('/actors?page=1&per_page=3',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 3)
+
+    def test_400_invalid_actors_per_page(self):
+        '''tests a bad request response when per_page is not positive'''
+        res=self.client().get('/actors?per_page=0',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+    
+    def test_cursor_paginate_actors(self):
+        '''tests walking the actors with the keyset cursor'''
+        res=self.client().get('/actors?limit=2',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+        next_res=self.client().get('/actors?limit=2&after={}'.format(data['next_cursor']),headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        next_data=json.loads(next_res.data)
+        actors=[i.format() for i in Actors.query.order_by(Actors.id).limit(4).all()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(next_res.status_code, 200)
+        self.assertListEqual(data['actors']+next_data['actors'], actors)
+
+    def test_400_invalid_actors_cursor(self):
+        '''tests a bad request response for a malformed cursor'''
+        res=self.client().get('/actors?after=not-a-cursor',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+    
+    def test_filter_actors(self):
+        '''tests the gender and age range filters of the actors'''
+        res=self.client().get('/actors?gender=female&min_age=20&max_age=60',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+        total=Actors.query.filter(Actors.gender=='female',Actors.age>=20,Actors.age<=60).count()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_actors'], total)
+        self.assertTrue(all(a['gender']=='female' and 20<=a['age']<=60 for a in data['actors']))
+
+    def test_search_actors_by_name_prefix(self):
+        '''tests the case insensitive name prefix search'''
+        res=self.client().get('/actors?q=ACTOR',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all(a['name'].lower().startswith('actor') for a in data['actors']))
+
+    def test_400_filter_actors_invalid_age(self):
+        '''tests a bad request response for a non integer age filter'''
+        res=self.client().get('/actors?min_age=twenty',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_actors_sparse_fieldset_compact(self):
+        '''tests selecting some fields of the actors in the column oriented format'''
+        res=self.client().get('/actors?fields=name,age&compact=true&per_page=5',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+        actors=Actors.query.order_by(Actors.id).limit(5).all()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertListEqual(sorted(data['actors'].keys()), ['age','name'])
+        self.assertListEqual(data['actors']['name'], [a.name for a in actors])
+
+    def test_400_actors_unknown_field(self):
+        '''tests a bad request response when selecting a field that doesn't exist'''
+        res=self.client().get('/actors?fields=name,salary',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_304_actors_not_modified(self):
+        '''tests that an unchanged actors list isn't sent again, and is after a write'''
+        res=self.client().get('/actors',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        etag=res.headers['ETag']
+        not_modified=self.client().get('/actors',headers={"Authorization":"Bearer {}".format(self.executive_producer),"If-None-Match":etag})
+        self.client().patch('/actors/1',json={'age':30},headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        modified=self.client().get('/actors',headers={"Authorization":"Bearer {}".format(self.executive_producer),"If-None-Match":etag})
+
+        self.assertEqual(res.status_code,200)
+        self.assertEqual(not_modified.status_code,304)
+        self.assertEqual(not_modified.data,b'')
+        self.assertEqual(modified.status_code,200)
+        self.assertNotEqual(modified.headers['ETag'],etag)
+
+    def test_cached_actors_invalidated_by_write(self):
+        '''tests that a repeated actors page comes from the cache until an actor is modified'''
+        first=self.client().get('/actors?per_page=7',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        second=self.client().get('/actors?per_page=7',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        self.client().patch('/actors/1',json={'age':31},headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        third=self.client().get('/actors?per_page=7',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+
+        self.assertEqual(second.headers['X-Cache'],'HIT')
+        self.assertEqual(second.data,first.data)
+        self.assertEqual(third.headers['X-Cache'],'MISS')
+
+    def test_server_timing_actors(self):
+        '''tests that the time spent in the auth, the database and the encoding is sent back'''
+        res=self.client().get('/actors?per_page=3&page=2',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        timing=res.headers['Server-Timing']
+
+        self.assertEqual(res.status_code,200)
+        self.assertIn('auth;dur=',timing)
+        self.assertIn('db;dur=',timing)
+        self.assertIn('serialize;dur=',timing)
+        self.assertIn('total;dur=',timing)
+
     def test_200_delete_actor(self):
         '''tests if deleting an actor works fine'''
         res=self.client().delete('/actors/4',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
@@ -183,6 +316,84 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['inserted'],added_to_db.name)
         self.assertTrue(data['success'])
     
+    def test_total_actors_counter_after_insert(self):
+        '''tests that the maintained actors counter follows the inserts'''
+        res=self.client().post('/actors',json={'name':'counter actor','age':33,'gender':'female'},headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code,200)
+        self.assertEqual(data['total_actors'],Actors.query.count())
+        self.assertEqual(count_rows(Actors),Actors.query.count())
+
+    def test_200_bulk_add_actors(self):
+        '''tests adding many actors at once, invalid and repeated ones are skipped'''
+        actors=[{'name':'bulk actor','age':30,'gender':'male'},
+        {'name':'bulk actor','age':30,'gender':'male'},
+        {'name':'bulk actor','age':'30','gender':'male'}]
+        res=self.client().post('/actors/bulk',json=actors,headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code,200)
+        self.assertTrue(data['success'])
+        self.assertEqual([r['status'] for r in data['results']][1:],['duplicate','invalid'])
+        self.assertEqual(Actors.query.filter(Actors.name=='bulk actor').count(),1)
+
+    def test_200_bulk_add_actors_ndjson(self):
+        '''tests adding many actors from an NDJSON stream'''
+        body='\n'.join(json.dumps({'name':'ndjson actor','age':age,'gender':'female'}) for age in [20,21])
+        res=self.client().post('/actors/bulk',data=body,content_type='application/x-ndjson',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code,200)
+        self.assertEqual(len(data['results']),2)
+
+    def test_400_bulk_add_actors_not_a_list(self):
+        '''tests a bad request response when the bulk body is not a list'''
+        res=self.client().post('/actors/bulk',json=self.new_actor,headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code,400)
+        self.assertFalse(data['success'])
+
+    def test_200_import_actors_csv(self):
+        '''tests importing a CSV roster, the invalid and repeated records are skipped'''
+        body='name,age,gender\ncsv actor,40,Male\ncsv actor,40,male\ncsv actor,forty,male\ncsv actor,41,female\n'
+        res=self.client().post('/actors/import',data=body,content_type='text/csv',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code,200)
+        self.assertEqual([data['inserted'],data['duplicates'],data['invalid']],[2,1,1])
+        self.assertEqual(data['invalid_records'],[2])
+        self.assertEqual(data['total_actors'],Actors.query.count())
+        self.assertEqual(Actors.query.filter(Actors.name=='csv actor',Actors.age==40).one().gender,'male')
+
+    def test_200_import_movies_ndjson(self):
+        '''tests importing movies from an NDJSON stream'''
+        body='\n'.join([json.dumps({'title':'ndjson movie','release_date':'2012-01-01'}),json.dumps({'title':'ndjson movie','release_date':'2012'})])
+        res=self.client().post('/movies/import',data=body,content_type='application/x-ndjson',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code,200)
+        self.assertEqual([data['inserted'],data['invalid']],[1,1])
+        self.assertEqual(data['total_movies'],Movies.query.count())
+
+    def test_400_import_unknown_format(self):
+        '''tests that only CSV and NDJSON files are imported'''
+        res=self.client().post('/movies/import',data='title',content_type='text/plain',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        self.assertEqual(res.status_code,400)
+
+    def test_import_command(self):
+        '''tests importing a roster file with the flask command'''
+        roster=tempfile.NamedTemporaryFile('w',suffix='.csv',delete=False)
+        roster.write('title,release_date\ncommand movie,2013-03-03\n')
+        roster.close()
+        result=self.app.test_cli_runner().invoke(args=['import-rows','movies',roster.name])
+        os.remove(roster.name)
+
+        self.assertEqual(result.exit_code,0)
+        self.assertIn('Imported 1 movies',result.output)
+        self.assertEqual(Movies.query.filter(Movies.title=='command movie').count(),1)
+
     def test_422_no_repeated_actors_allowed(self):
         ''' tests an unprocessable unity when adding and already existing actor'''
         res=self.client().post('/actors',json=self.new_actor,headers={"Authorization":"Bearer {}".format(self.executive_producer)})
@@ -205,6 +416,15 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(modified.name,'aymen boudabia')
         self.assertEqual(modified.age,25)
     
+    def test_422_patch_actor_into_existing_actor(self):
+        '''tests an unprocessable unity when patching an actor into an already existing one'''
+        self.client().post('/actors',json=self.new_actor,headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        res=self.client().patch('/actors/2',json={'name':self.new_actor['name'],'age':self.new_actor['age']},headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code,422)
+        self.assertFalse(data['success'])
+
     def test_400_patch_actor_with_empty_body(self):
         '''tests a bad request response by patching an actor with an empty body'''
         res=self.client().patch('actors/1',json={},headers={"Authorization":"Bearer {}".format(self.executive_producer)})
@@ -266,6 +486,24 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(len(data['movies']), 10)
 
     
+    def test_filter_movies_by_release_date(self):
+        '''tests the released_after/released_before filters and the sort by release date'''
+        res=self.client().get('/movies?released_after=1990-01-01&released_before=2010-12-31&sort=release_date',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+        dates=[m['release_date'] for m in data['movies']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertListEqual(dates, sorted(dates))
+        self.assertTrue(all('1990-01-01'<=d<='2010-12-31' for d in dates))
+
+    def test_400_filter_movies_invalid_date(self):
+        '''tests a bad request response for a release date filter not in yyyy-mm-dd'''
+        res=self.client().get('/movies?released_after=01-01-1990',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
     def test_200_delete_movie(self):
         '''tests if deleting a movie works fine'''
         res=self.client().delete('/movies/4',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
@@ -323,7 +561,7 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code,200)
         self.assertTrue(data['success'])
         self.assertEqual(data['updated'],1)
-        self.assertEqual(modified.release_date,'1994-09-23')
+        self.assertEqual(modified.release_date.isoformat(),'1994-09-23')
     
     def test_400_patch_movie_with_empty_body(self):
         '''tests a bad request response by patching a movie with an empty body'''
@@ -341,8 +579,699 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(res.status_code,400)
 
+    def count_queries(self,path):
+        '''returns the response of a GET request and the number of queries it ran'''
+        queries=[]
+        def count(*args):
+            queries.append(args[2])
+        event.listen(db.engine,'before_cursor_execute',count)
+        try:
+            res=self.client().get(path,headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        finally:
+            event.remove(db.engine,'before_cursor_execute',count)
+        return res,len(queries)
+
+    def test_internal_token_stats(self):
+        '''tests that the verified tokens cache counts its hits and misses'''
+        self.app.config['INTERNAL_API_KEY']='internal key'
+        self.client().get('/actors',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        res=self.client().get('/internal/tokens',headers={'X-Internal-Key':'internal key'})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code,200)
+        self.assertGreaterEqual(data['hits']+data['misses'],1)
+        self.assertEqual(self.client().get('/internal/tokens').status_code,401)
+
+    def test_write_without_counter_fails(self):
+        '''tests that a write can't commit without the counter of its table'''
+        class Unknown:
+            __tablename__='Unknown'
+        with self.assertRaises(RuntimeError):
+            record_write(Unknown,1)
+        db.session.rollback()
+
+    def test_200_add_casting(self):
+        '''tests casting an actor in a movie'''
+        res=self.client().post('/movies/2/actors',json={'actor_id':2,'role':'lead','start_date':'2030-01-01','end_date':'2030-02-01'},
+            headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code,200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['total_castings'],Castings.query.count())
+
+    def test_400_add_casting_ending_before_start(self):
+        '''tests that a casting can't end before it starts'''
+        res=self.client().post('/movies/2/actors',json={'actor_id':2,'role':'lead','start_date':'2030-02-01','end_date':'2030-01-01'},
+            headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        self.assertEqual(res.status_code,400)
+
+    def test_404_add_casting_unexisting_movie(self):
+        '''tests casting an actor in a movie which doesn't exist'''
+        res=self.client().post('/movies/99999/actors',json={'actor_id':2,'role':'lead','start_date':'2030-01-01','end_date':'2030-02-01'},
+            headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        self.assertEqual(res.status_code,404)
+
+    def test_movie_actors_and_actor_movies(self):
+        '''tests the cast of a movie and the movies of an actor'''
+        self.client().post('/movies/3/actors',json={'actor_id':3,'role':'villain','start_date':'2030-03-01','end_date':'2030-04-01'},
+            headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        actors=json.loads(self.client().get('/movies/3/actors',headers={"Authorization":"Bearer {}".format(self.executive_producer)}).data)
+        movies=json.loads(self.client().get('/actors/3/movies',headers={"Authorization":"Bearer {}".format(self.executive_producer)}).data)
+
+        self.assertIn(3,[actor['id'] for actor in actors['actors']])
+        self.assertIn('villain',[actor['role'] for actor in actors['actors']])
+        self.assertIn(3,[movie['id'] for movie in movies['movies']])
+        self.assertEqual(movies['total_movies'],len(movies['movies']))
+
+    def test_include_cast_bounded_queries(self):
+        '''tests that the cast of a movies page is loaded with the same number of queries whatever the page size'''
+        self.client().post('/movies/4/actors',json={'actor_id':4,'role':'lead','start_date':'2030-05-01','end_date':'2030-06-01'},
+            headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        small,small_queries=self.count_queries('/movies?include=cast&per_page=2')
+        large,large_queries=self.count_queries('/movies?include=cast&per_page=20')
+        movies=json.loads(large.data)['movies']
+
+        self.assertEqual(large.status_code,200)
+        self.assertEqual(small_queries,large_queries)
+        self.assertLessEqual(large_queries,6)
+        self.assertTrue(all('cast' in movie for movie in movies))
+        self.assertTrue(any(len(movie['cast'])>0 for movie in movies))
+
+    def test_400_unknown_include(self):
+        '''tests that only the cast can be included'''
+        res=self.client().get('/movies?include=crew',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        self.assertEqual(res.status_code,400)
+
+    def test_200_available_actors(self):
+        '''tests that an actor cast during the dates isn't available'''
+        self.client().post('/movies/5/actors',json={'actor_id':5,'role':'lead','start_date':'2031-01-01','end_date':'2031-01-31'},
+            headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        res=self.client().get('/actors/available?start=2031-01-10&end=2031-01-20&per_page=100&fields=name',
+            headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code,200)
+        self.assertNotIn(Actors.query.get(5).name,[actor['name'] for actor in data['actors']])
+        self.assertEqual(data['total_actors'],len(data['actors']))
+
+    def test_400_available_actors_invalid_dates(self):
+        '''tests that both dates are required and the end can't be before the start'''
+        missing=self.client().get('/actors/available?start=2031-01-10',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        invalid=self.client().get('/actors/available?start=2031-01-10&end=tomorrow',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        reversed_=self.client().get('/actors/available?start=2031-01-20&end=2031-01-10',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+
+        self.assertEqual(missing.status_code,400)
+        self.assertEqual(invalid.status_code,400)
+        self.assertEqual(reversed_.status_code,400)
+
+    def test_422_double_booking(self):
+        '''tests that an actor can't be cast in two movies at the same time'''
+        first=self.client().post('/movies/6/actors',json={'actor_id':6,'role':'lead','start_date':'2031-03-01','end_date':'2031-03-31'},
+            headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        second=self.client().post('/movies/7/actors',json={'actor_id':6,'role':'lead','start_date':'2031-03-31','end_date':'2031-04-30'},
+            headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+
+        self.assertEqual(first.status_code,200)
+        self.assertEqual(second.status_code,422)
+
+    def test_200_export_actors_ndjson(self):
+        '''tests exporting all the actors as NDJSON'''
+        res=self.client().get('/actors/export',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        actors=[json.loads(line) for line in res.data.decode().splitlines()]
+        first=Actors.query.order_by(Actors.id).first()
+
+        self.assertEqual(res.status_code,200)
+        self.assertEqual(res.mimetype,'application/x-ndjson')
+        self.assertEqual(len(actors),Actors.query.count())
+        self.assertEqual(actors[0],dict(id=first.id,**first.format()))
+
+    def test_200_export_movies_csv(self):
+        '''tests exporting the selected fields of the movies as CSV'''
+        res=self.client().get('/movies/export?format=csv&fields=title',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        lines=res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code,200)
+        self.assertEqual(lines[0],'id,title')
+        self.assertEqual(len(lines),Movies.query.count()+1)
+
+    def test_400_export_unknown_format(self):
+        '''tests that only NDJSON and CSV exports exist'''
+        res=self.client().get('/movies/export?format=xml',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        self.assertEqual(res.status_code,400)
+
+    def test_200_batch_update_actors(self):
+        '''tests updating several actors with one request'''
+        res=self.client().patch('/actors',json={'ids':[1,2],'changes':{'gender':'Female'}},
+            headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code,200)
+        self.assertEqual(data['updated'],2)
+        self.assertEqual([Actors.query.get(1).gender,Actors.query.get(2).gender],['female','female'])
+
+    def test_400_batch_update_invalid(self):
+        '''tests that a batch needs ids or filters and valid changes'''
+        no_selection=self.client().patch('/actors',json={'changes':{'age':30}},headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        invalid_change=self.client().patch('/actors',json={'ids':[1],'changes':{'age':'old'}},headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        invalid_ids=self.client().patch('/movies',json={'ids':['1'],'changes':{'title':'x'}},headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+
+        self.assertEqual(no_selection.status_code,400)
+        self.assertEqual(invalid_change.status_code,400)
+        self.assertEqual(invalid_ids.status_code,400)
+
+    def test_200_batch_delete_movies(self):
+        '''tests deleting movies by ids with their castings'''
+        movie=Movies(title='batch deleted movie',release_date=date(2032,1,1))
+        movie.insert()
+        movie_id=movie.id
+        self.client().post('/movies/{}/actors'.format(movie_id),json={'actor_id':3,'role':'extra','start_date':'2032-01-01','end_date':'2032-01-02'},
+            headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        res=self.client().delete('/movies',json={'ids':[movie_id,999999]},headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code,200)
+        self.assertEqual(data['deleted'],1)
+        self.assertEqual(data['total_movies'],Movies.query.count())
+        self.assertEqual(Castings.query.filter(Castings.movie_id==movie_id).count(),0)
+
+    def test_200_batch_delete_actors_by_filter(self):
+        '''tests deleting the actors matching the filters of the query string'''
+        Actors(name='batch deleted actor',age=3,gender='male').insert()
+        res=self.client().delete('/actors?q=batch%20deleted&max_age=3',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+
+        self.assertEqual(res.status_code,200)
+        self.assertEqual(data['deleted'],1)
+        self.assertEqual(data['total_actors'],Actors.query.count())
+
+    def test_batch_delete_body_without_json_content_type(self):
+        '''tests that the ids of a body sent without a JSON content type still restrict the batch
+        and that a body which isn't a JSON object is refused'''
+        Actors(name='batch kept actor',age=4,gender='male').insert()
+        actor=Actors(name='batch deleted actor',age=4,gender='male')
+        actor.insert()
+        actor_id=actor.id
+        res=self.client().delete('/actors?max_age=4',data=json.dumps({'ids':[actor_id]}),headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        data=json.loads(res.data)
+        malformed=self.client().delete('/actors?max_age=4',data='{"ids":[1',headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+        not_object=self.client().delete('/actors?max_age=4',json=[actor_id],headers={"Authorization":"Bearer {}".format(self.executive_producer)})
+
+        self.assertEqual(res.status_code,200)
+        self.assertEqual(data['deleted'],1)
+        self.assertEqual(Actors.query.filter(Actors.name=='batch kept actor').count(),1)
+        self.assertEqual(malformed.status_code,400)
+        self.assertEqual(not_object.status_code,400)
+
+
+
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS cache test case, it uses a local JWKS file"""
+
+    def setUp(self):
+        self.now=0
+        self.fetches=0
+        jwks_file=tempfile.NamedTemporaryFile('w',suffix='.json',delete=False)
+        json.dump({'keys':[{'kid':'key1','kty':'RSA','use':'sig','n':'abc','e':'AQAB'}]},jwks_file)
+        jwks_file.close()
+        self.jwks_path=jwks_file.name
+        self.read_file=file_fetcher(self.jwks_path)
+        self.cache=JWKSCache(self.fetcher,ttl=100,min_refresh_interval=10,clock=lambda: self.now)
+
+    def tearDown(self):
+        os.remove(self.jwks_path)
+
+    def fetcher(self):
+        self.fetches+=1
+        return self.read_file()
+
+    def test_keys_are_fetched_once(self):
+        '''tests that the keys are served from memory until the ttl expires'''
+        self.cache.get_key('key1')
+        self.cache.get_key('key1')
+        self.assertEqual(self.fetches,1)
+
+        self.now=150
+        self.assertEqual(self.cache.get_key('key1')['n'],'abc')
+        self.assertEqual(self.fetches,2)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        '''tests that an unknown kid refetches the keys at most once per interval'''
+        self.cache.get_key('key1')
+        self.now=20
+        self.assertIsNone(self.cache.get_key('rotated'))
+        self.assertIsNone(self.cache.get_key('rotated'))
+        self.assertEqual(self.fetches,2)
+
+    def test_stale_keys_served_when_fetch_fails(self):
+        '''tests that the cached keys are still used when the issuer can't be reached'''
+        self.cache.get_key('key1')
+        open(self.jwks_path,'w').close() #invalid JSON
+        self.now=150
+        self.assertEqual(self.cache.get_key('key1')['kid'],'key1')
+
+    def test_first_fetch_failure_raises(self):
+        '''tests that a failing fetch without cached keys is an error'''
+        cache=JWKSCache(file_fetcher('/nonexistent/jwks.json'))
+        with self.assertRaises(Exception):
+            cache.get_key('key1')
+
+    def test_failed_first_fetch_is_rate_limited(self):
+        '''tests that without cached keys a failed fetch is only retried after the interval'''
+        open(self.jwks_path,'w').close() #invalid JSON
+        for _ in range(3):
+            with self.assertRaises(Exception):
+                self.cache.get_key('key1')
+        self.assertEqual(self.fetches,1)
+
+        self.now=10
+        with self.assertRaises(Exception):
+            self.cache.get_key('key1')
+        self.assertEqual(self.fetches,2)
+
+    def test_concurrent_cold_start_fetches_once(self):
+        '''tests that the requests waiting for the first fetch don't fetch again'''
+        def slow_fetcher():
+            time.sleep(0.05)
+            return self.fetcher()
+        cache=JWKSCache(slow_fetcher,ttl=100,min_refresh_interval=10,clock=lambda: self.now)
+        keys=[]
+        threads=[threading.Thread(target=lambda: keys.append(cache.get_key('key1'))) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.fetches,1)
+        self.assertEqual([key['kid'] for key in keys],['key1']*16)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        self.now=1000
+        self.cache=TokenCache(maxsize=2,clock=lambda: self.now)
+        self.payload={'permissions':['get:actors'],'exp':2000}
+
+    def test_cached_payload_until_exp(self):
+        '''tests that a verified payload is served until the token expires'''
+        self.assertIsNone(self.cache.get('token1'))
+        self.cache.set('token1',self.payload)
+        self.assertEqual(self.cache.get('token1'),self.payload)
+
+        self.now=2000
+        self.assertIsNone(self.cache.get('token1'))
+        self.assertEqual(self.cache.stats()['hits'],1)
+        self.assertEqual(self.cache.stats()['misses'],2)
+
+    def test_cache_is_bounded(self):
+        '''tests that the least recently used token is evicted'''
+        self.cache.set('token1',self.payload)
+        self.cache.set('token2',self.payload)
+        self.cache.get('token1')
+        self.cache.set('token3',self.payload)
+
+        self.assertIsNotNone(self.cache.get('token1'))
+        self.assertIsNone(self.cache.get('token2'))
+        self.assertEqual(self.cache.stats()['size'],2)
+
+    def test_payload_without_exp_not_cached(self):
+        '''tests that tokens without an exp claim are always verified'''
+        self.cache.set('token1',{'permissions':[]})
+        self.assertIsNone(self.cache.get('token1'))
+
+
+class JSONProviderTestCase(unittest.TestCase):
+    """This class represents the JSON responses encoding test case"""
+
+    def setUp(self):
+        self.app=Flask(__name__)
+        self.rows=[(1,'tom hanks',65,'male'),(2,'emma "stone"',33,None)]
+        self.fields=['name','age','gender']
+
+    def test_rows_same_output_for_every_backend(self):
+        '''tests that the rows are encoded as the equivalent list of dicts'''
+        expected=[dict(zip(self.fields,row[1:])) for row in self.rows]
+        with self.app.app_context():
+            for backend in JSON_BACKENDS:
+                self.app.config['JSON_BACKEND']=backend
+                res=jsonify({'actors':Rows(self.fields,self.rows),'total_actors':2})
+                data=json.loads(res.data)
+
+                self.assertListEqual(data['actors'],expected)
+                self.assertEqual(data['total_actors'],2)
+
+    def test_rows_compact(self):
+        '''tests the column oriented encoding of the rows'''
+        with self.app.app_context():
+            res=jsonify({'actors':Rows(self.fields,self.rows,compact=True)})
+            data=json.loads(res.data)
+
+        self.assertListEqual(data['actors']['age'],[65,33])
+
+    def test_rows_related(self):
+        '''tests that the related lists are added to their rows by every backend'''
+        cast={1:[{'title':'big','release_date':date(1988,6,3)}]}
+        with self.app.app_context():
+            for backend in JSON_BACKENDS:
+                self.app.config['JSON_BACKEND']=backend
+                data=json.loads(jsonify({'actors':Rows(self.fields,self.rows,related={'cast':cast})}).data)
+
+                self.assertEqual(data['actors'][0]['cast'],[{'title':'big','release_date':'1988-06-03'}])
+                self.assertEqual(data['actors'][1]['cast'],[])
+
+    def test_rows_ndjson(self):
+        '''tests that every backend writes one object per line'''
+        for backend,dumps in JSON_BACKENDS.items():
+            lines=Rows(self.fields,self.rows).to_ndjson(dumps).decode().splitlines()
+
+            self.assertEqual(len(lines),len(self.rows))
+            self.assertEqual([json.loads(line) for line in lines],Rows(self.fields,self.rows).to_python())
+
+
+class ChunksReaderTestCase(unittest.TestCase):
+    """This class represents the COPY input reader test case"""
+
+    def test_read_sizes(self):
+        '''tests that the chunks are read back whatever the size of the reads'''
+        reader=ChunksReader([b'abc',b'',b'defgh',b'ij'])
+
+        self.assertEqual(reader.read(2),b'ab')
+        self.assertEqual(reader.read(5),b'cdefg')
+        self.assertEqual(reader.read(),b'hij')
+        self.assertEqual(reader.read(4),b'')
+
+
+class ConditionalTestCase(unittest.TestCase):
+    """This class represents the conditional requests dates test case"""
+
+    def test_no_last_modified_during_the_write_second(self):
+        '''tests that a write of the current second gives no Last-Modified, a following write
+        in the same second would have the same HTTP date'''
+        self.assertIsNone(stable_last_modified(datetime.utcnow()))
 
+    def test_last_modified_of_past_writes(self):
+        '''tests that an older write gives its date, cut to the second'''
+        updated_at=datetime.utcnow()-timedelta(seconds=5)
+        last_modified=stable_last_modified(updated_at)
+
+        self.assertEqual(last_modified.replace(tzinfo=None),updated_at.replace(microsecond=0))
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """This class represents the response cache backends test case"""
+
+    def test_local_backend_lru(self):
+        '''tests that the local backend keeps the most recently used responses'''
+        now=[0]
+        backend=LocalBackend(maxsize=2,clock=lambda: now[0])
+        backend.set('a',(b'{}','application/json'),ttl=10)
+        backend.set('b',(b'{}','application/json'))
+        backend.get('a')
+        backend.set('c',(b'{}','application/json'))
+
+        self.assertIsNone(backend.get('b'))
+        self.assertIsNotNone(backend.get('a'))
+        now[0]=10
+        self.assertIsNone(backend.get('a'))
+
+    def test_shared_backend(self):
+        '''tests the shared backend with the local stand-in of the key/value server'''
+        client=DictClient()
+        writer=SharedBackend(client)
+        reader=SharedBackend(client)
+        writer.set('key',(b'{"total_actors":1}','application/json'),ttl=60)
+
+        self.assertEqual(reader.get('key'),(b'{"total_actors":1}','application/json'))
+        self.assertIsNone(reader.get('other'))
+
+    def test_hit_ratio(self):
+        '''tests the hit ratio of the cache'''
+        cache=ResponseCache(LocalBackend())
+        cache.hits=3
+        cache.misses=1
+        self.assertEqual(cache.stats()['hit_ratio'],0.75)
+
+
+class PoolMetricsTestCase(unittest.TestCase):
+    """This class represents the connection pool metrics test case"""
+
+    def setUp(self):
+        pool_metrics.reset()
+        self.engine=create_engine('sqlite://',poolclass=TimedQueuePool,pool_size=1,max_overflow=0,pool_timeout=0.1)
+        pool_metrics.attach(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_checkouts(self):
+        '''tests that checkouts and checked out connections are counted'''
+        connection=self.engine.connect()
+        stats=pool_metrics.stats(self.engine)
+        self.assertEqual(stats['checkouts'],1)
+        self.assertEqual(stats['checked_out'],1)
+        self.assertEqual(stats['wait_count'],1)
+
+        connection.close()
+        stats=pool_metrics.stats(self.engine)
+        self.assertEqual(stats['checkins'],1)
+        self.assertEqual(stats['checked_out'],0)
+
+    def test_timeout(self):
+        '''tests that a checkout of an exhausted pool is counted as a timeout'''
+        connection=self.engine.connect()
+        with self.assertRaises(exc.TimeoutError):
+            self.engine.connect()
+        connection.close()
+
+        stats=pool_metrics.stats(self.engine)
+        self.assertEqual(stats['timeouts'],1)
+        self.assertGreaterEqual(stats['wait_time_max'],0.1)
+
+    def test_attach_once(self):
+        '''tests that attaching the metrics twice doesn't count twice'''
+        pool_metrics.attach(self.engine)
+        self.engine.connect().close()
+        self.assertEqual(pool_metrics.stats(self.engine)['checkouts'],1)
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """This class represents the read replicas routing test case, with SQLite stand-ins"""
+
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        primary='sqlite:///'+os.path.join(self.dir,'primary.db')
+        replica='sqlite:///'+os.path.join(self.dir,'replica.db')
+        missing='sqlite:///'+os.path.join(self.dir,'missing','replica.db') #refuses connections
+        for url,name in [(primary,'primary'),(replica,'replica')]:
+            with create_engine(url).begin() as connection:
+                connection.execute(text('CREATE TABLE servers (name VARCHAR)'))
+                connection.execute(text('INSERT INTO servers VALUES (:name)'),{'name':name})
+
+        self.app=Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI']=primary
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS']=False
+        self.app.config['SQLALCHEMY_REPLICA_URIS']=[missing,replica]
+        db=RoutingSQLAlchemy(self.app)
+        setup_replicas(self.app)
+        servers=db.Table('servers',db.Column('name',db.String))
+
+        def read():
+            return {'servers':[row.name for row in db.session.execute(db.select([servers.c.name]))]}
+
+        @self.app.route('/servers',methods=['GET','POST'])
+        def servers_endpoint():
+            return read()
+
+        @self.app.route('/servers/write')
+        def write_then_read():
+            db.session.execute(servers.insert(),{'name':'new'})
+            db.session.commit()
+            return read()
+
+        self.client=self.app.test_client
+
+    def test_replicas_pool_not_timed(self):
+        '''tests that the waits for a replica connection are not counted in the metrics of the primary pool'''
+        app=Flask(__name__)
+        app.config['SQLALCHEMY_ENGINE_OPTIONS']={'poolclass':TimedQueuePool,'pool_size':1}
+        app.config['SQLALCHEMY_REPLICA_URIS']=['sqlite:///'+os.path.join(self.dir,'replica.db')]
+        setup_replicas(app)
+        engine=app.extensions['replicas'].engines[0]
+
+        self.assertNotIsInstance(engine.pool,TimedQueuePool)
+        self.assertEqual(engine.pool.size(),1)
+        self.assertIs(app.config['SQLALCHEMY_ENGINE_OPTIONS']['poolclass'],TimedQueuePool)
+
+    def test_get_reads_replica(self):
+        '''tests that a replica failing a read is ejected and the next GET requests read from a healthy one'''
+        router=self.app.extensions['replicas']
+        failed=self.client().get('/servers')
+        for i in range(2):
+            data=json.loads(self.client().get('/servers').data)
+            self.assertEqual(data['servers'],['replica'])
+        self.assertEqual(failed.status_code,500)
+        self.assertEqual(len(router.ejected),1)
+        self.assertFalse(router.healthy(router.engines[0]))
+
+    def test_replica_checked_when_coming_back(self):
+        '''tests that only a replica coming back after its retry time is checked before reading from it'''
+        router=self.app.extensions['replicas']
+        missing,replica=router.engines
+        router.ejected[missing]=router.clock()-1 #its retry time is over, it still refuses connections
+        data=json.loads(self.client().get('/servers').data)
+
+        self.assertEqual(data['servers'],['replica'])
+        self.assertFalse(router.healthy(missing))
+        self.assertGreater(router.ejected[missing],router.clock())
+
+    def test_post_reads_primary(self):
+        '''tests that the other requests use the primary'''
+        data=json.loads(self.client().post('/servers').data)
+        self.assertEqual(data['servers'],['primary'])
+
+    def test_read_your_writes(self):
+        '''tests that a request reads from the primary after writing'''
+        data=json.loads(self.client().get('/servers/write').data)
+        self.assertEqual(data['servers'],['primary','new'])
+
+    def test_all_replicas_down(self):
+        '''tests that the reads go to the primary without healthy replica'''
+        router=self.app.extensions['replicas']
+        for engine in router.engines:
+            router.eject(engine)
+        data=json.loads(self.client().get('/servers').data)
+        self.assertEqual(data['servers'],['primary'])
+
+
+class ASGITestCase(unittest.TestCase):
+    """This class represents the ASGI entry point test case"""
+
+    def test_http_request(self):
+        '''tests that a request goes through the ASGI app to the Flask views'''
+        flask_app=Flask(__name__)
+        flask_app.add_url_rule('/ping','ping',lambda: jsonify({'success':True}))
+        scope={'type':'http','http_version':'1.1','method':'GET','scheme':'http','path':'/ping',
+            'raw_path':b'/ping','root_path':'','query_string':b'','headers':[],'server':('localhost',80)}
+        messages=[]
+
+        async def receive():
+            return {'type':'http.request','body':b'','more_body':False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(ASGIApp(flask_app,threads=2)(scope,receive,send))
+        self.assertEqual(messages[0]['status'],200)
+        body=b''.join(message.get('body',b'') for message in messages[1:])
+        self.assertEqual(json.loads(body),{'success':True})
+
+    def test_keys_refreshed_in_background(self):
+        '''tests that the signing keys are fetched periodically outside of the requests'''
+        fetches=[]
+        def fetcher():
+            fetches.append(1)
+            return {'keys':[{'kid':'key1'}]}
+        cache=JWKSCache(fetcher,min_refresh_interval=0)
+
+        async def run():
+            task=asyncio.create_task(refresh_periodically(cache,interval=0.01))
+            await asyncio.sleep(0.05)
+            task.cancel()
+
+        asyncio.run(run())
+        self.assertGreaterEqual(len(fetches),2)
+        self.assertEqual(cache.get_key('key1'),{'kid':'key1'})
+
+
+class TimingTestCase(unittest.TestCase):
+    """This class represents the request instrumentation test case"""
+
+    def setUp(self):
+        self.app=Flask(__name__)
+        self.app.config['QUERY_COUNT_WARNING']=2
+        engine=create_engine('sqlite://')
+        timing.init_timing(self.app,[engine])
+
+        @self.app.route('/queries/<int:count>')
+        def queries(count):
+            with engine.connect() as connection:
+                for i in range(count):
+                    connection.execute(text('SELECT 1'))
+            return jsonify({'queries':count})
+
+        self.client=self.app.test_client
+
+    def test_server_timing(self):
+        '''tests the metrics of the Server-Timing header'''
+        res=self.client().get('/queries/2')
+        timing_header=res.headers['Server-Timing']
+        self.assertIn('db;dur=',timing_header)
+        self.assertIn('desc="2 queries"',timing_header)
+        self.assertIn('serialize;dur=',timing_header)
+
+    def test_too_many_queries_warning(self):
+        '''tests that a request over the query count threshold is logged as a warning'''
+        with self.assertLogs('casting_agency.requests','WARNING') as logs:
+            self.client().get('/queries/3')
+        entry=json.loads(logs.records[0].getMessage())
+        self.assertEqual(entry['queries'],3)
+        self.assertEqual(entry['status'],200)
+        self.assertIn('warning',entry)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """This class represents the Prometheus metrics test case"""
+
+    def setUp(self):
+        self.app=Flask(__name__)
+        self.engine=create_engine('sqlite://',poolclass=TimedQueuePool)
+        metrics.init_metrics(self.app,self.engine)
+        self.app.add_url_rule('/metrics-test/<int:id>','metrics_test',lambda id: jsonify({'id':id}))
+        self.app.add_url_rule('/metrics-test/private','metrics_private',requires_auth('get:actors')(lambda: jsonify({})))
+        self.client=self.app.test_client
+
+    def sample(self,name,labels=None):
+        return metrics.REGISTRY.get_sample_value(name,labels or {}) or 0
+
+    def test_requests_by_route_and_status(self):
+        '''tests that the requests are counted by url rule and status, and their latency observed'''
+        labels={'method':'GET','route':'/metrics-test/<int:id>','status':'200'}
+        before=self.sample('http_requests_total',labels)
+        self.client().get('/metrics-test/1')
+        self.client().get('/metrics-test/2')
+        self.assertEqual(self.sample('http_requests_total',labels)-before,2)
+        self.assertGreaterEqual(self.sample('http_request_duration_seconds_count',{'method':'GET','route':'/metrics-test/<int:id>'}),2)
+
+    def test_auth_failure_reason(self):
+        '''tests that a rejected request is counted with the code of its AuthError'''
+        labels={'reason':'authorization_header_missing'}
+        before=self.sample('auth_failures_total',labels)
+        res=self.client().get('/metrics-test/private')
+        self.assertEqual(res.status_code,401)
+        self.assertEqual(self.sample('auth_failures_total',labels)-before,1)
+
+    def test_metrics_endpoint(self):
+        '''tests the text format of GET /metrics and its token'''
+        self.assertEqual(self.client().get('/metrics').status_code,404)
+
+        self.app.config['METRICS_TOKEN']='secret'
+        self.assertEqual(self.client().get('/metrics').status_code,401)
+        with self.engine.connect():
+            res=self.client().get('/metrics',headers={'Authorization':'Bearer secret'})
+        self.assertEqual(res.status_code,200)
+        self.assertIn(b'http_requests_total',res.data)
+        self.assertIn(b'db_pool_checked_out 1.0',res.data)
 
+    def test_jwks_fetch_latency(self):
+        '''tests that the fetches of the signing keys are observed'''
+        fetch=metrics.timed_fetcher(lambda: {'keys':[]})
+        before=self.sample('jwks_fetch_duration_seconds_count',{'outcome':'success'})
+        fetch()
+        self.assertEqual(self.sample('jwks_fetch_duration_seconds_count',{'outcome':'success'})-before,1)
 
 
 # Make the tests conveniently executable
@@ -0,0 +1,122 @@
+import json
+import time
+import logging
+from contextlib import contextmanager
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+
+logger = logging.getLogger('casting_agency.requests')
+
+########## Request instrumentation ##############
+'''
+Every request measures the time spent in the authentication, in the
+database (cursor events of the engines) and in the JSON encoding, and its
+number of queries. They are sent in the Server-Timing header (shown by the
+browser devtools) and logged as one JSON line per request. A request running
+more than QUERY_COUNT_WARNING queries is logged as a warning, it is most
+likely loading rows one by one (N+1 queries).
+'''
+
+class RequestTimings:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.durations = {} #name -> seconds
+        self.queries = 0
+
+    def add(self, name, seconds):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self, total):
+        metrics = []
+        for name, seconds in self.durations.items():
+            metric = f'{name};dur={seconds * 1000:.2f}'
+            if name == 'db':
+                metric += f';desc="{self.queries} queries"'
+            metrics.append(metric)
+        metrics.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(metrics)
+
+
+def current_timings():
+    if not has_request_context():
+        return None
+    return g.get('timings')
+
+@contextmanager
+def timed(name):
+    ''' adds the duration of the block to the timings of the current request'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = current_timings()
+        if timings is not None:
+            timings.add(name, time.perf_counter() - start)
+
+
+#Database time:
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start'].pop()
+    timings = current_timings()
+    if timings is not None:
+        timings.add('db', time.perf_counter() - start)
+        timings.queries += 1
+
+def attach(engine):
+    ''' measures the queries of the engine, only once'''
+    if event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+        return
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+#Hooks:
+def start_timing():
+    g.timings = RequestTimings()
+
+def finish_timing(response):
+    timings = g.pop('timings', None)
+    if timings is None:
+        return response
+    total = timings.total()
+    if current_app.config.get('SERVER_TIMING', True):
+        response.headers['Server-Timing'] = timings.server_timing(total)
+
+    entry = {
+        'method': request.method,
+        'path': request.full_path if request.query_string else request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round(total * 1000, 2),
+        'queries': timings.queries
+    }
+    for name, seconds in timings.durations.items():
+        entry[f'{name}_ms'] = round(seconds * 1000, 2)
+
+    threshold = current_app.config.get('QUERY_COUNT_WARNING', 20)
+    if threshold and timings.queries > threshold:
+        entry['warning'] = 'too many queries, N+1 loading?'
+        logger.warning(json.dumps(entry))
+    else:
+        logger.info(json.dumps(entry))
+    return response
+
+def init_timing(app, engines):
+    ''' instruments the requests of the app and the queries of the engines'''
+    for engine in engines:
+        attach(engine)
+    if not logger.handlers: #the lines are already JSON, written as they are
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(app.config.get('REQUEST_LOG_LEVEL', 'INFO'))
+    app.before_request(start_timing)
+    app.after_request(finish_timing)
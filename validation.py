@@ -0,0 +1,96 @@
+from datetime import datetime
+
+########## Request bodies validation ##############
+'''
+Rules shared by every endpoint creating or modifying actors, movies and castings.
+'''
+
+GENDERS = ['male','female']
+DATE_FORMAT = "%Y-%m-%d"
+
+def valid_name(name):
+    return isinstance(name,str) and len(name)>0
+
+def valid_age(age):
+    return type(age)==int
+
+def valid_id(id):
+    return type(id)==int
+
+def valid_gender(gender):
+    return isinstance(gender,str) and gender.lower() in GENDERS
+
+def valid_release_date(release_date):
+    ''' the release date must be yyyy-mm-dd'''
+    try:
+        datetime.strptime(release_date,DATE_FORMAT)
+    except:
+        return False
+    return True
+
+def parse_date(value):
+    ''' converts a valid yyyy-mm-dd string to a date'''
+    return datetime.strptime(value,DATE_FORMAT).date()
+
+def valid_actor(actor):
+    ''' checks that the actor has all the necessary informations in the expected format'''
+    if not isinstance(actor,dict):
+        return False
+    if 'name' not in actor or 'age' not in actor or 'gender' not in actor:
+        return False
+    return valid_name(actor['name']) and valid_age(actor['age']) and valid_gender(actor['gender'])
+
+def valid_movie(movie):
+    ''' checks that the movie has all the necessary informations in the expected format'''
+    if not isinstance(movie,dict):
+        return False
+    if 'title' not in movie or 'release_date' not in movie:
+        return False
+    return valid_name(movie['title']) and valid_release_date(movie['release_date'])
+
+def valid_casting(casting):
+    ''' checks the actor id, the role and the dates (yyyy-mm-dd) of a casting, it can't end before it starts'''
+    if not isinstance(casting,dict):
+        return False
+    if any(key not in casting for key in ['actor_id','role','start_date','end_date']):
+        return False
+    if not (valid_id(casting['actor_id']) and valid_name(casting['role'])):
+        return False
+    if not (valid_release_date(casting['start_date']) and valid_release_date(casting['end_date'])):
+        return False
+    return parse_date(casting['start_date'])<=parse_date(casting['end_date'])
+
+def valid_ids(ids):
+    return isinstance(ids,list) and len(ids)>0 and all(valid_id(id) for id in ids)
+
+def actor_changes(actor):
+    ''' columns changed by a patch of actors (name, age, gender), None if it is empty
+    or has an unknown or invalid attribute'''
+    if not isinstance(actor,dict) or len(actor)==0:
+        return None
+    changes={}
+    for attribute,value in actor.items():
+        if attribute=='name' and valid_name(value):
+            changes['name']=value
+        elif attribute=='age' and valid_age(value):
+            changes['age']=value
+        elif attribute=='gender' and valid_gender(value):
+            changes['gender']=value.lower()
+        else:
+            return None
+    return changes
+
+def movie_changes(movie):
+    ''' columns changed by a patch of movies (title, release date), None if it is empty
+    or has an unknown or invalid attribute'''
+    if not isinstance(movie,dict) or len(movie)==0:
+        return None
+    changes={}
+    for attribute,value in movie.items():
+        if attribute=='title' and valid_name(value):
+            changes['title']=value
+        elif attribute=='release_date' and valid_release_date(value):
+            changes['release_date']=parse_date(value)
+        else:
+            return None
+    return changes